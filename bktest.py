@@ -18,7 +18,6 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from fwim import *
-import pickle
 
 import sys, time
 
@@ -35,22 +34,17 @@ def build_bktree(words):
     penalties = PlainLevenshteinPenalties()
     dev = EditDistanceEvaluator(penalties)
     bktree = BKTree(dev)
-    
-    for w in words:
-      bktree.add_word(w)
-      
+    bktree.bulk_build(words)
     return bktree
 
 def create_bktree(filename):
     words = load_words()
     buildstart = time.time()
     bktree = build_bktree(words)
-    ofile = open(filename, mode='wb')
-    pickle.dump(bktree, ofile)
-    ofile.close()
+    bktree.save(filename)
 
 def query_bktree(filename):
-    bktree = load_bktree(filename)
+    bktree = open_bktree(filename)
     searchstart = time.time()
     results = bktree.find('hello', 20)
     searchend = time.time()
@@ -58,9 +52,10 @@ def query_bktree(filename):
 
     print(results)
 
-def load_bktree(filename):
-    bktree = pickle.load(open(filename, mode='rb'))
-    return bktree
+def open_bktree(filename):
+    penalties = PlainLevenshteinPenalties()
+    dev = EditDistanceEvaluator(penalties)
+    return load_bktree(filename, dev)
 
 
 if __name__ == '__main__':
@@ -17,6 +17,28 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import copy
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import unicodedata
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class BasicPenalties():
     """Basic Damerau-Levenshtein distance errors."""
 
@@ -27,6 +49,33 @@ class BasicPenalties():
         self.swap_penalty = 10      # 'ab' -> 'ac'
         self.end_add_penalty = 10   # Add penalty when source string is exhausted.
 
+    def __setattr__(self, name, value):
+        # Every configuration change bumps the revision so that
+        # compiled tables built from this object can be discarded.
+        object.__setattr__(self, name, value)
+        self.mark_changed()
+
+    def mark_changed(self):
+        object.__setattr__(self, 'revision', getattr(self, 'revision', 0) + 1)
+
+    def fingerprint(self):
+        """A hashable value that is the same for all penalty
+        objects of the same class and configuration."""
+        cached = getattr(self, 'fingerprint_cache', None)
+        if cached is not None and cached[0] == self.revision:
+            return cached[1]
+        items = []
+        for (name, value) in sorted(vars(self).items()):
+            if name in ('revision', 'fingerprint_cache'):
+                continue
+            if isinstance(value, dict):
+                value = tuple(sorted(value.items()))
+            items.append((name, value))
+        result = (type(self).__name__, tuple(items))
+        # Stored without bumping the revision.
+        object.__setattr__(self, 'fingerprint_cache', (self.revision, result))
+        return result
+
     def get_transpose_penalty(self):
         return self.transpose_penalty
 
@@ -62,6 +111,23 @@ an exception will be thrown."""
             return 0
         return self.get_swap_penalty()
 
+    def min_swap_cost(self, fold=None):
+        """The smallest cost of replacing a character
+with a different one. If fold is given, only pairs
+of characters that fold differently count."""
+        return self.get_swap_penalty()
+
+    def swap_key(self, character):
+        """Two different characters with different keys swap for
+get_swap_penalty(), unless swap_partners pairs them. A subclass
+that changes swap_cost changes these two to match."""
+        return character
+
+    def swap_partners(self, character):
+        """Characters whose swap cost with character, either way
+round, may not be get_swap_penalty() although their keys differ."""
+        return []
+
 class PlainLevenshteinPenalties(BasicPenalties):
     """A set where the transposition penalty is so
 large that it is never chosen."""
@@ -105,6 +171,7 @@ class CustomSwapPenalties(BasicPenalties):
     def set_penalty(self, character1, character2, penalty_value):
         self.check_params_single_characters(character1, character2)
         self.penalties[(character1, character2)] = penalty_value
+        self.mark_changed()
 
     def swap_cost(self, character1, character2):
         self.check_params_single_characters(character1, character2)
@@ -113,6 +180,24 @@ class CustomSwapPenalties(BasicPenalties):
             return self.penalties[key]
         return super(CustomSwapPenalties, self).swap_cost(character1, character2)
 
+    def swap_partners(self, character):
+        partners = super(CustomSwapPenalties, self).swap_partners(character)
+        for (character1, character2) in self.penalties:
+            if character1 == character:
+                partners.append(character2)
+            elif character2 == character:
+                partners.append(character1)
+        return partners
+
+    def min_swap_cost(self, fold=None):
+        result = super(CustomSwapPenalties, self).min_swap_cost(fold)
+        for ((character1, character2), penalty) in self.penalties.items():
+            if character1 == character2 or penalty >= result:
+                continue
+            if fold is None or fold(character1) != fold(character2):
+                result = penalty
+        return result
+
 class IgnoreOrderPenalties(CustomSwapPenalties):
 
     def __init__(self):
@@ -144,6 +229,7 @@ class ErrorGroupPenalties(CustomSwapPenalties):
             self.groups[c] = base_character
         self.groups[base_character] = base_character
         self.group_penalties[base_character] = penalty
+        self.mark_changed()
     
     def swap_cost(self, character1, character2):
         if character1 == character2:
@@ -158,6 +244,17 @@ class ErrorGroupPenalties(CustomSwapPenalties):
                     return self.group_penalties[base1]
         return super(ErrorGroupPenalties, self).swap_cost(character1, character2)
 
+    def swap_key(self, character):
+        return self.groups.get(character, character)
+
+    def min_swap_cost(self, fold=None):
+        result = super(ErrorGroupPenalties, self).min_swap_cost(fold)
+        for (base, penalty) in self.group_penalties.items():
+            members = [c for (c, b) in self.groups.items() if b == base]
+            if fold is None or len(set([fold(c) for c in members])) > 1:
+                result = min(result, penalty)
+        return result
+
 accent_groups = [
                  ('a', 'áàäâã'),
                  ('e', 'éèëêẽ'),
@@ -168,6 +265,22 @@ accent_groups = [
                  ('n', 'ñ'),
                  ('s', 'ŝ')]
 
+def fold_character(character, groups=None):
+    """The canonical form of a character: the base of its group in
+    groups (a dict from character to base, as in ErrorGroupPenalties),
+    otherwise the character without accents, in lower case."""
+    if groups and character in groups:
+        character = groups[character]
+    else:
+        decomposed = unicodedata.normalize('NFD', character)
+        base = ''.join([c for c in decomposed if not unicodedata.combining(c)])
+        if len(base) == 1:
+            character = base
+    lower = character.lower()
+    if len(lower) == 1:
+        character = lower
+    return character
+
 def add_accent_groups(group_penalty, penalty_value):
     global accent_groups
     for g in accent_groups:
@@ -194,69 +307,596 @@ class CaseInsensitiveIgnoreOrderPenalties(CustomSwapPenalties):
     def swap_cost(self, character1, character2):
         (character1, character2) = self.order_and_lower(character1, character2)
         return super(CaseInsensitiveIgnoreOrderPenalties, self).swap_cost(character1, character2)
+
+    def swap_key(self, character):
+        return character.lower()
+
+    def swap_partners(self, character):
+        return super(CaseInsensitiveIgnoreOrderPenalties, self).swap_partners(
+            character.lower())
+
+    def min_swap_cost(self, fold=None):
+        # Characters that only differ in case are swapped for free,
+        # unless fold does not tell them apart.
+        if fold is None or fold('A') != fold('a'):
+            return 0
+        return super(CaseInsensitiveIgnoreOrderPenalties, self).min_swap_cost(fold)
     
 
 
-class EditDistanceEvaluator():
+# Returned by EditDistanceEvaluator.distance when
+# the distance is larger than the requested limit.
+OVER_LIMIT = float('inf')
+# Encoded sources an evaluator keeps, enough for a block of queries.
+SOURCE_CACHE_SIZE = 1024
+
+class CompiledPenalties():
+    """A frozen cost table built from a penalty object.
+
+The penalty object is copied when the table is built, so later
+changes to it are not seen here. Characters are given dense
+indices the first time they are encoded. Most pairs of characters
+swap for swap_penalty, so per character only the costs that differ
+from it are stored, in a dict by index, and the inner loop of the
+distance computation is a list lookup and a dict get instead of a
+chain of method calls. Only the known characters with the same
+swap_key or a swap_partners key are asked about, so the table grows
+with the alphabet, not with its square."""
+
+    def __init__(self, penalties):
+        self.revision = getattr(penalties, 'revision', None)
+        self.penalties = copy.deepcopy(penalties)
+        self.transpose_penalty = self.penalties.get_transpose_penalty()
+        self.drop_penalty = self.penalties.get_drop_penalty()
+        self.add_penalty = self.penalties.get_add_penalty()
+        self.swap_penalty = self.penalties.get_swap_penalty()
+        self.end_add_penalty = self.penalties.get_end_add_penalty()
+        self.min_add_penalty = min(self.add_penalty, self.end_add_penalty)
+        # No single edit costs less than this per plain Levenshtein
+        # edit; a transposition counts as two of them.
+        self.min_edit_penalty = min(self.min_add_penalty, self.drop_penalty,
+                                    self.penalties.min_swap_cost(),
+                                    self.transpose_penalty/2)
+        # The same, but a transposition counts as a single edit.
+        self.min_operation_penalty = min(self.min_add_penalty,
+                                         self.drop_penalty,
+                                         self.penalties.min_swap_cost(),
+                                         self.transpose_penalty)
+        self.__check_uniform()
+        self.alphabet = {}  # character -> index
+        self.characters = []
+        # costs[i].get(j, swap_penalty) is the cost of swapping i to j.
+        self.costs = []
+        self.keys = {}      # swap_key -> indices of the characters
+        # Stays true as long as every known character matches
+        # itself for free, which allows skipping equal strings.
+        self.free_identity = True
+
+    def __check_uniform(self):
+        # When every edit costs the same the distance is a multiple
+        # of plain Levenshtein or optimal string alignment distance,
+        # which have bit-parallel algorithms.
+        self.uniform_cost = None
+        self.uniform_transpose = False
+        if type(self.penalties).swap_cost is not BasicPenalties.swap_cost:
+            return
+        cost = self.swap_penalty
+        if cost <= 0 or self.drop_penalty != cost or \
+                self.add_penalty != cost or self.end_add_penalty != cost:
+            return
+        if self.transpose_penalty == cost:
+            self.uniform_transpose = True
+        elif self.transpose_penalty < 2*cost:
+            return
+        self.uniform_cost = cost
+
+    def index(self, character):
+        """The dense index of a single character."""
+        i = self.alphabet.get(character)
+        if i is None:
+            i = self.__add_character(character)
+        return i
+
+    def __add_character(self, character):
+        penalties = self.penalties
+        swap_cost = penalties.swap_cost
+        default = self.swap_penalty
+        new_index = len(self.characters)
+        new_row = {}
+        for i in self.related(character):
+            c = self.characters[i]
+            cost = swap_cost(c, character)
+            if cost != default:
+                self.costs[i][new_index] = cost
+            cost = swap_cost(character, c)
+            if cost != default:
+                new_row[i] = cost
+        own_cost = swap_cost(character, character)
+        new_row[new_index] = own_cost
+        if own_cost != 0:
+            self.free_identity = False
+        self.costs.append(new_row)
+        self.characters.append(character)
+        self.alphabet[character] = new_index
+        self.keys.setdefault(penalties.swap_key(character), []).append(new_index)
+        return new_index
+
+    def related(self, character):
+        """The indices of the known characters whose swap cost with
+        character may differ from the swap penalty."""
+        penalties = self.penalties
+        related = set(self.keys.get(penalties.swap_key(character), ()))
+        for partner in penalties.swap_partners(character):
+            related.update(self.keys.get(penalties.swap_key(partner), ()))
+        return related
+
+    def encode(self, word):
+        """Turns a string into a list of character indices."""
+        alphabet = self.alphabet
+        codes = []
+        for c in word:
+            i = alphabet.get(c)
+            if i is None:
+                i = self.__add_character(c)
+            codes.append(i)
+        return codes
+
+    def swap_cost(self, character1, character2):
+        return self.costs[self.index(character1)].get(self.index(character2),
+                                                      self.swap_penalty)
+
+    def offset_bound(self, offset, final_offset):
+        """A lower bound for any edit path that goes through a cell
+        whose source position is offset characters ahead of its
+        target position and ends final_offset characters ahead."""
+        if offset > 0:
+            bound = offset*self.drop_penalty
+        else:
+            bound = -offset*self.min_add_penalty
+        if final_offset > offset:
+            bound += (final_offset - offset)*self.drop_penalty
+        else:
+            bound += (offset - final_offset)*self.min_add_penalty
+        return bound
+
+    def length_bound(self, source_length, target_length):
+        """A lower bound for the distance of any two strings
+        with the given lengths."""
+        return self.offset_bound(source_length - target_length,
+                                 source_length - target_length)
+
+    def band(self, source_length, target_length, limit):
+        """The range of offsets (source position minus target position)
+        that a path costing at most limit can visit, or None if there
+        is no such path."""
+        final_offset = source_length - target_length
+        if self.offset_bound(final_offset, final_offset) > limit:
+            return None
+        low = final_offset
+        while low > -target_length and \
+                self.offset_bound(low - 1, final_offset) <= limit:
+            low -= 1
+        high = final_offset
+        while high < source_length and \
+                self.offset_bound(high + 1, final_offset) <= limit:
+            high += 1
+        return (low, high)
+
+
+def shallow_size(container):
+    """Bytes taken by a container and the objects right inside it
+    (keys and values of a dict), as an estimate of memory use."""
+    size = sys.getsizeof(container)
+    if isinstance(container, dict):
+        for (key, value) in container.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    else:
+        for item in container:
+            size += sys.getsizeof(item)
+    return size
+
+
+class Instrumented():
+    """Optional counters and timings, to find out why something is slow.
+They are off by default. enable_stats() puts timed wrappers of the
+methods named in instrumented_methods on the instance, so while stats
+are off those methods run exactly as before. Loops that count cells
+or nodes keep local totals and only add them when stats are on.
+The counters of parts, like the evaluator of a matcher, are turned on
+and off with it and show up in stats() under the part's name."""
+
+    instrumented_methods = ()
+    stats_counters = None
+    stats_hook = None
+
+    def stats_parts(self):
+        """(name, part) for the instrumented objects this one uses."""
+        return []
+
+    def enable_stats(self, hook=None):
+        """Starts counting. hook(name, stats) is called by export_stats,
+        for passing the counters on to a metrics system."""
+        self.stats_counters = collections.Counter()
+        self.stats_hook = hook
+        for name in self.instrumented_methods:
+            setattr(self, name, self.timed(name, getattr(type(self), name)))
+        for (name, part) in self.stats_parts():
+            part.enable_stats()
+
+    def disable_stats(self):
+        for name in self.instrumented_methods:
+            self.__dict__.pop(name, None)
+        self.stats_counters = None
+        self.stats_hook = None
+        for (name, part) in self.stats_parts():
+            part.disable_stats()
+
+    def timed(self, name, method):
+        """A wrapper of method that counts calls, time and the size of
+        results, or calls that gave OVER_LIMIT."""
+        counters = self.stats_counters
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            counters['seconds.' + name] += time.perf_counter() - start
+            counters['calls.' + name] += 1
+            if isinstance(result, (list, set, dict)):
+                counters['results.' + name] += len(result)
+            elif result == OVER_LIMIT:
+                counters['over_limit.' + name] += 1
+            return result
+        return wrapper
+
+    def memory_footprint(self):
+        """An estimate of the bytes held by the indexes."""
+        return 0
+
+    def stats(self):
+        """The counters as a flat dict, empty while stats are off, with
+        the memory footprint in bytes. Computing the footprint walks
+        the indexes, so this is not meant to be called per query."""
+        if self.stats_counters is None:
+            return {}
+        result = dict(self.stats_counters)
+        result['memory_bytes'] = self.memory_footprint()
+        for (name, part) in self.stats_parts():
+            for (key, value) in part.stats().items():
+                result[name + '.' + key] = value
+        return result
+
+    def reset_stats(self):
+        if self.stats_counters is not None:
+            self.stats_counters.clear()
+        for (name, part) in self.stats_parts():
+            part.reset_stats()
+
+    def export_stats(self):
+        """Passes stats() to the hook given to enable_stats and
+        returns them."""
+        result = self.stats()
+        if self.stats_hook is not None:
+            self.stats_hook(type(self).__name__, result)
+        return result
+
+    def __getstate__(self):
+        # Wrappers can not be pickled, so copies sent to worker
+        # processes start with stats off.
+        state = dict(self.__dict__)
+        for name in self.instrumented_methods + ('stats_counters', 'stats_hook'):
+            state.pop(name, None)
+        return state
+
+
+class EditDistanceEvaluator(Instrumented):
     """Damerau-Levenshtein distance evaluator.
     This algorithm is not a metric."""
+
+    instrumented_methods = ('distance',)
+
     def __init__(self, penalties):
         self.penalties = penalties
         self.print_debug = False
+        self.compiled = None
+        self.source_cache = (None, {})   # table, source -> [codes, masks]
+        self.target_cache = (None, None, None)
+        self.memo = None
+
+    def enable_memo(self, max_size=65536, memo=None):
+        """Remembers exact distances of up to max_size pairs. Pass the
+        memo of another evaluator to share it, for example between BK
+        trees with the same penalties; keys include the penalty
+        fingerprint, so evaluators with other penalties can share it
+        too. Returns the memo, an LRUCache with hit rate stats()."""
+        if memo is None:
+            memo = LRUCache(max_size)
+        self.memo = memo
+        return memo
+
+    def disable_memo(self):
+        self.memo = None
+
+    def timed(self, name, method):
+        wrapper = super(EditDistanceEvaluator, self).timed(name, method)
+        if name != 'distance':
+            return wrapper
+        counters = self.stats_counters
+        def distance(source, target, limit=None):
+            result = wrapper(source, target, limit)
+            table = self.compiled
+            if result == OVER_LIMIT and \
+                    table.band(len(source), len(target), limit) is None:
+                counters['band_exits'] += 1
+            elif table.uniform_cost is not None and not self.print_debug:
+                counters['bit_parallel'] += 1
+            return result
+        return distance
 
-    def distance(self, source, target):
+    def count_cells(self, l1, low, high, columns):
+        """Adds the cells of the first columns of a banded matrix."""
+        cells = 0
+        for j in range(1, columns+1):
+            cells += max(0, min(l1, j+high) - max(1, j+low) + 1)
+        self.stats_counters['cells'] += cells
+
+    def memory_footprint(self):
+        size = 0
+        if self.compiled is not None:
+            size += sum([sys.getsizeof(row) for row in self.compiled.costs])
+        if self.memo is not None:
+            size += shallow_size(self.memo.entries)
+        return size
+
+    def stats(self):
+        result = super(EditDistanceEvaluator, self).stats()
+        if result and self.memo is not None:
+            for (key, value) in self.memo.stats().items():
+                result['memo.' + key] = value
+        return result
+
+    def get_compiled(self):
+        """The compiled form of the penalties. It is rebuilt
+        whenever the penalties have been changed."""
+        compiled = self.compiled
+        if compiled is None or \
+                compiled.revision != getattr(self.penalties, 'revision', None):
+            compiled = CompiledPenalties(self.penalties)
+            self.compiled = compiled
+        return compiled
+
+    def distance(self, source, target, limit=None):
+        """The edit distance from source to target. If limit is given,
+        distances larger than it are not computed exactly and
+        OVER_LIMIT is returned instead."""
         if type(source) != type('s'):
             raise TypeError('Source is not a string.')
         if type(target) != type('s'):
             raise TypeError('Target is not a string.')
 
+        table = self.get_compiled()
+        memo = self.memo
+        if memo is not None and not self.print_debug:
+            key = (self.penalties.fingerprint(), source, target)
+            result = memo.get(key)
+            if result is not None:
+                if limit is not None and result > limit:
+                    return OVER_LIMIT
+                return result
         if len(source) == 0:
-            return self.penalties.get_add_penalty()*len(target)
-        if len(target) == 0:
-            return self.penalties.get_drop_penalty()*len(source)
+            result = table.add_penalty*len(target)
+        elif len(target) == 0:
+            result = table.drop_penalty*len(source)
+        else:
+            result = self.__distance(table, source, target, limit)
+        if limit is not None and result > limit:
+            return OVER_LIMIT
+        if memo is not None and not self.print_debug:
+            # Results within the limit are exact.
+            memo.put(key, result)
+        return result
+
+    def __source_entry(self, table, source):
+        # Matchers compare one query, or a block of queries, against
+        # many words, so the encodings of recent sources are kept.
+        (cached_table, sources) = self.source_cache
+        if cached_table is not table:
+            sources = {}
+            self.source_cache = (table, sources)
+        entry = sources.get(source)
+        if entry is None:
+            if len(sources) >= SOURCE_CACHE_SIZE:
+                sources.clear()
+            entry = [None, None]
+            sources[source] = entry
+        return entry
+
+    def __encode_source(self, table, source):
+        entry = self.__source_entry(table, source)
+        if entry[0] is None:
+            entry[0] = table.encode(source)
+        return entry[0]
+
+    def __encode_target(self, table, target):
+        # Blocks of queries compare every word with several queries
+        # in a row, so the last target encoding is kept.
+        if self.target_cache[0] is not table or self.target_cache[1] != target:
+            self.target_cache = (table, target, table.encode(target))
+        return self.target_cache[2]
 
-        return self.__distance(source, target)
+    def __source_bits(self, table, source):
+        # Per character, the bit mask of the positions where it
+        # appears in source, for the bit-parallel algorithm. Built
+        # from the characters, so the cost table is not touched.
+        entry = self.__source_entry(table, source)
+        if entry[1] is None:
+            masks = {}
+            for (i, c) in enumerate(source):
+                masks[c] = masks.get(c, 0) | (1 << i)
+            entry[1] = masks
+        return entry[1]
 
-    def __distance(self, source, target):
+    def __bit_parallel_distance(self, table, source, target):
+        # Myers' algorithm in Hyyro's formulation, with Hyyro's
+        # extension for transpositions. Source positions are bits
+        # of Python integers, so every target character is handled
+        # in a few integer operations regardless of source length.
+        masks = self.__source_bits(table, source)
+        transpositions = table.uniform_transpose
+        full = (1 << len(source)) - 1
+        last = 1 << (len(source) - 1)
+        positive = full
+        negative = 0
+        score = len(source)
+        previous_match = 0
+        previous_diagonal = 0
+        for c in target:
+            match = masks.get(c, 0)
+            diagonal = (((match & positive) + positive) ^ positive) | \
+                match | negative
+            if transpositions:
+                diagonal |= (((~previous_diagonal) & match) << 1) & \
+                    previous_match
+                previous_match = match
+                previous_diagonal = diagonal
+            horizontal_positive = (negative | ~(diagonal | positive)) & full
+            horizontal_negative = positive & diagonal
+            if horizontal_positive & last:
+                score += 1
+            elif horizontal_negative & last:
+                score -= 1
+            horizontal_positive = ((horizontal_positive << 1) | 1) & full
+            horizontal_negative = (horizontal_negative << 1) & full
+            positive = (horizontal_negative | ~(diagonal | horizontal_positive)) & full
+            negative = horizontal_positive & diagonal
+        return score*table.uniform_cost
+
+    def __distance(self, table, source, target, limit):
         l1 = len(source)
         l2 = len(target)
-        d = []
-        for i in range(l1+1):
-            d.append([0]*(l2+1))
-        
-        for i in range(l1+1):
-            d[i][0] = i*self.penalties.get_drop_penalty()
-        for j in range(l2+1):
-            d[0][j] = j*self.penalties.get_add_penalty()
+        if limit is None:
+            (low, high) = (-l2, l1)
+        else:
+            band = table.band(l1, l2, limit)
+            if band is None:
+                return OVER_LIMIT
+            (low, high) = band
+        if table.uniform_cost is not None and not self.print_debug:
+            return self.__bit_parallel_distance(table, source, target)
+        s = self.__encode_source(table, source)
+        if source == target and table.free_identity:
+            return 0
+        t = self.__encode_target(table, target)
+        source_rows = [table.costs[c].get for c in s]
+        swap = table.swap_penalty
+        drop = table.drop_penalty
+        add = table.add_penalty
+        end_add = table.end_add_penalty
+        transpose = table.transpose_penalty
+        debug_columns = [] if self.print_debug else None
 
+        # Only the current column and the two before it are kept,
+        # cells outside the band stay at OVER_LIMIT.
+        previous2 = None
+        previous = [OVER_LIMIT]*(l1+1)
+        for i in range(min(l1, high) + 1):
+            previous[i] = i*drop
+        previous_min = 0
         for j in range(1, l2+1):
-            for i in range(1, l1+1):
-                source_loc = i-1
-                target_loc = j-1
-                source_letter = source[source_loc]
-                target_letter = target[target_loc]
-                subst_penalty = d[i-1][j-1] + \
-                    self.penalties.swap_cost(source_letter, target_letter)
-                del_penalty = d[i-1][j] + self.penalties.get_drop_penalty()
-                if j > l1:
-                    add_pen = self.penalties.get_end_add_penalty()
-                else:
-                    add_pen = self.penalties.get_add_penalty()
-                add_penalty = d[i][j-1] + add_pen
+            target_code = t[j-1]
+            if j >= 2:
+                before_code = t[j-2]
+            else:
+                before_code = -1
+            if j > l1:
+                add_pen = end_add
+            else:
+                add_pen = add
+            current = [OVER_LIMIT]*(l1+1)
+            if -j >= low:
+                current[0] = j*add
+            column_min = current[0]
+            first = max(1, j+low)
+            last = min(l1, j+high)
+            for i in range(first, last+1):
+                source_code = s[i-1]
+                total_penalty = previous[i-1] + source_rows[i-1](target_code, swap)
+                del_penalty = current[i-1] + drop
+                if del_penalty < total_penalty:
+                    total_penalty = del_penalty
+                add_penalty = previous[i] + add_pen
+                if add_penalty < total_penalty:
+                    total_penalty = add_penalty
                 # Transpose is tricky.
-                if i >= 2 and j >= 2 and source[source_loc] == target[target_loc-1] and \
-                        source[source_loc-1] == target[target_loc]:
-                    transpose_penalty = d[i-2][j-2] + self.penalties.get_transpose_penalty()
-                else:
-                    transpose_penalty = del_penalty + 1 # Ensures this won't be chosen.
-                total_penalty = min(subst_penalty, del_penalty,\
-                                        add_penalty, transpose_penalty)
-                d[i][j] = total_penalty
-            
-        if self.print_debug:
+                if i >= 2 and source_code == before_code and \
+                        s[i-2] == target_code:
+                    transpose_penalty = previous2[i-2] + transpose
+                    if transpose_penalty < total_penalty:
+                        total_penalty = transpose_penalty
+                current[i] = total_penalty
+                if total_penalty < column_min:
+                    column_min = total_penalty
+            if debug_columns is not None:
+                debug_columns.append(previous)
+            # Two columns over the limit, see next_column.
+            if limit is not None and column_min > limit and \
+                    previous_min > limit:
+                if self.stats_counters is not None:
+                    self.stats_counters['early_exits'] += 1
+                    self.count_cells(l1, low, high, j)
+                return OVER_LIMIT
+            previous2 = previous
+            previous = current
+            previous_min = column_min
+
+        if self.stats_counters is not None:
+            self.count_cells(l1, low, high, l2)
+        if debug_columns is not None:
+            debug_columns.append(previous)
+            d = [[column[i] for column in debug_columns] for i in range(l1+1)]
             self.print_matrix(source, target, d)
-        return d[-1][-1]
+        return previous[l1]
     
+    def first_column(self, table, source_length):
+        """Column 0 of the distance matrix, for use with next_column."""
+        return [i*table.drop_penalty for i in range(source_length+1)]
+
+    def next_column(self, table, s, previous2, previous, target_code,
+                    before_code, j):
+        """Column j of the distance matrix for the encoded source s,
+        given columns j-2 and j-1 and the codes of target characters
+        j and j-1 (before_code is -1 for the first character). This
+        lets callers that build targets one character at a time share
+        the columns of common prefixes. A transposition can skip one
+        column, so a search can only give up on a target, or on the
+        targets that continue it, once two consecutive columns are
+        over its limit."""
+        drop = table.drop_penalty
+        transpose = table.transpose_penalty
+        costs = table.costs
+        swap = table.swap_penalty
+        if j > len(s):
+            add_pen = table.end_add_penalty
+        else:
+            add_pen = table.add_penalty
+        current = [j*table.add_penalty]
+        above = current[0]
+        for i in range(1, len(s)+1):
+            source_code = s[i-1]
+            total_penalty = previous[i-1] + costs[source_code].get(target_code, swap)
+            del_penalty = above + drop
+            if del_penalty < total_penalty:
+                total_penalty = del_penalty
+            add_penalty = previous[i] + add_pen
+            if add_penalty < total_penalty:
+                total_penalty = add_penalty
+            if i >= 2 and source_code == before_code and \
+                    s[i-2] == target_code:
+                transpose_penalty = previous2[i-2] + transpose
+                if transpose_penalty < total_penalty:
+                    total_penalty = transpose_penalty
+            current.append(total_penalty)
+            above = total_penalty
+        return current
+
     def print_matrix(self, source, target, d):
         print('\n   ', end='')
         for i in target:
@@ -275,7 +915,492 @@ class EditDistanceEvaluator():
             print('')
             
 
-class BasicWordMatcher():
+class WordBlock():
+    """Words encoded for BatchEditDistanceEvaluator: one row
+of character indices per word, padded to the longest word."""
+
+    def __init__(self, table, words):
+        self.table = table
+        self.words = list(words)
+        longest = max([len(w) for w in self.words] + [0])
+        self.codes = numpy.zeros((len(self.words), longest), dtype=numpy.intp)
+        self.lengths = numpy.zeros(len(self.words), dtype=numpy.intp)
+        for (k, w) in enumerate(self.words):
+            self.codes[k, :len(w)] = table.encode(w)
+            self.lengths[k] = len(w)
+
+    def size(self):
+        return len(self.words)
+
+
+class BatchEditDistanceEvaluator(EditDistanceEvaluator):
+    """Computes the distance of one source string to a whole block of
+    target strings at once with NumPy. The distances are the same as
+    the ones EditDistanceEvaluator gives."""
+
+    instrumented_methods = ('distance', 'distances')
+
+    def __init__(self, penalties, block_size=4096):
+        if numpy is None:
+            raise ImportError('BatchEditDistanceEvaluator requires NumPy.')
+        super(BatchEditDistanceEvaluator, self).__init__(penalties)
+        self.block_size = block_size
+        self.cost_matrix = None
+
+    def prepare(self, targets):
+        """Encodes a list of target strings into a WordBlock."""
+        for t in targets:
+            if type(t) != type('s'):
+                raise TypeError('Target is not a string.')
+        return WordBlock(self.get_compiled(), targets)
+
+    def get_cost_matrix(self, table):
+        """The swap costs of table as a matrix. New characters are
+        filled in from the sparse costs of the table as it grows,
+        with room for twice as many kept so that a growing alphabet
+        does not copy the matrix every time."""
+        size = len(table.characters)
+        state = self.cost_matrix
+        if state is None or state[0] is not table:
+            values = [table.transpose_penalty, table.drop_penalty,
+                      table.add_penalty, table.end_add_penalty,
+                      table.swap_penalty]
+            if all(type(v) == int for v in values):
+                dtype = numpy.int64
+            else:
+                dtype = numpy.float64
+            costs = numpy.full((size, size), table.swap_penalty, dtype=dtype)
+            state = [table, costs, 0]
+            self.cost_matrix = state
+        (costs, filled) = (state[1], state[2])
+        if filled == size:
+            return costs[:size, :size]
+        if costs.shape[0] < size:
+            capacity = max(size, 2*costs.shape[0])
+            grown = numpy.full((capacity, capacity), table.swap_penalty,
+                               dtype=costs.dtype)
+            grown[:filled, :filled] = costs[:filled, :filled]
+            costs = grown
+        overrides = []
+        for i in range(filled, size):
+            for (j, cost) in table.costs[i].items():
+                overrides.append((i, j, cost))
+            for j in table.related(table.characters[i]):
+                if j < filled and i in table.costs[j]:
+                    overrides.append((j, i, table.costs[j][i]))
+        if costs.dtype == numpy.int64 and \
+                any(type(cost) != int for (i, j, cost) in overrides):
+            costs = costs.astype(numpy.float64)
+        for (i, j, cost) in overrides:
+            costs[i, j] = cost
+        state[1] = costs
+        state[2] = size
+        return costs[:size, :size]
+
+    def distances(self, source, targets, limit=None):
+        """The distances from source to every target, in order. Targets
+        is a list of strings or a WordBlock from prepare(). As with
+        distance(), values over limit are returned as OVER_LIMIT."""
+        if type(source) != type('s'):
+            raise TypeError('Source is not a string.')
+        table = self.get_compiled()
+        if not isinstance(targets, WordBlock) or targets.table is not table:
+            if isinstance(targets, WordBlock):
+                targets = targets.words
+            targets = self.prepare(targets)
+        s = table.encode(source)
+        matrix = self.get_cost_matrix(table)
+        results = []
+        for start in range(0, targets.size(), self.block_size):
+            end = start + self.block_size
+            block = self.__distances(table, matrix, s,
+                                     targets.codes[start:end],
+                                     targets.lengths[start:end], limit)
+            results.extend(block.tolist())
+        if limit is not None:
+            results = [r if r <= limit else OVER_LIMIT for r in results]
+        return results
+
+    def __distances(self, table, matrix, s, codes, lengths, limit):
+        l1 = len(s)
+        count = codes.shape[0]
+        dtype = matrix.dtype
+        drop = table.drop_penalty
+        add = table.add_penalty
+        results = numpy.full(count, l1*drop, dtype=dtype)
+        if l1 == 0:
+            return lengths.astype(dtype)*add
+        s = numpy.array(s, dtype=numpy.intp)
+        source_rows = matrix[s]
+        # Rows are source positions, columns are the target words.
+        drops = numpy.arange(l1+1, dtype=dtype).reshape(l1+1, 1)*drop
+        previous2 = None
+        previous = numpy.repeat(drops, count, axis=1)
+        previous_min = numpy.zeros(count, dtype=dtype)
+        for j in range(1, codes.shape[1]+1):
+            target_codes = codes[:, j-1]
+            if j > l1:
+                add_pen = table.end_add_penalty
+            else:
+                add_pen = add
+            best = previous[:-1] + source_rows[:, target_codes]
+            numpy.minimum(best, previous[1:] + add_pen, out=best)
+            if j >= 2 and l1 >= 2:
+                before_codes = codes[:, j-2]
+                swapped = (s[1:, None] == before_codes[None, :]) & \
+                    (s[:-1, None] == target_codes[None, :])
+                transposed = numpy.where(swapped,
+                        previous2[:-2] + table.transpose_penalty, best[1:])
+                numpy.minimum(best[1:], transposed, out=best[1:])
+            # Drops run down the column: current[i] is the smallest
+            # candidate[k] + (i-k)*drop for k <= i.
+            current = numpy.empty_like(previous)
+            current[0] = j*add
+            current[1:] = best
+            current -= drops
+            numpy.minimum.accumulate(current, axis=0, out=current)
+            current += drops
+            done = lengths == j
+            results[done] = current[l1, done]
+            column_min = current.min(axis=0)
+            if limit is not None:
+                alive = (lengths > j) & \
+                    ((column_min <= limit) | (previous_min <= limit))
+                if not alive.any():
+                    if dtype == numpy.float64:
+                        results[lengths > j] = numpy.inf
+                    else:
+                        results[lengths > j] = numpy.iinfo(dtype).max
+                    break
+            previous2 = previous
+            previous = current
+            previous_min = column_min
+        return results
+
+
+def sort_by_distance(matches):
+    """Sorts (distance, word) pairs by distance. There are few
+    distinct distances, so the pairs are grouped by distance
+    instead of sorting the whole list."""
+    groups = {}
+    for m in matches:
+        if m[0] in groups:
+            groups[m[0]].append(m)
+        else:
+            groups[m[0]] = [m]
+    result = []
+    for dist in sorted(groups):
+        result.extend(groups[dist])
+    return result
+
+
+class TopK():
+    """Keeps the k smallest (distance, word) pairs offered to it.
+Equal distances are ordered by the word, so the result does not
+depend on the order in which the words were seen."""
+
+    def __init__(self, k):
+        self.k = k
+        # A max-heap of the kept pairs: distances are negated and
+        # words are turned into keys that sort in reverse order.
+        self.heap = []
+
+    def bound(self):
+        """No pair with a larger distance can be kept any more."""
+        if not self.heap or len(self.heap) < self.k:
+            return OVER_LIMIT
+        return -self.heap[0][0]
+
+    def offer(self, distance, word):
+        if self.k <= 0 or distance > self.bound():
+            return
+        entry = (-distance, tuple([-ord(c) for c in word]) + (1,), word)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def result(self):
+        return sorted([(-e[0], e[2]) for e in self.heap])
+
+
+class LRUCache():
+    """A bounded mapping that drops the least recently used entry when
+it is full. With a ttl, entries older than ttl seconds are dropped
+when they are looked up. Counts hits, misses, evictions, expired
+entries and invalidations."""
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        if not isinstance(max_size, int) or max_size < 1:
+            raise TypeError('max_size must be a positive integer')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()  # key -> (time, value)
+        self.counters = {'hits' : 0, 'misses' : 0, 'evictions' : 0,
+                         'expired' : 0, 'invalidations' : 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and \
+                self.clock() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.counters['expired'] += 1
+            entry = None
+        if entry is None:
+            self.counters['misses'] += 1
+            return default
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.entries[key] = (self.clock(), value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def replace(self, key, value):
+        """Changes the value of an entry without making it recent
+        or resetting its age."""
+        self.entries[key] = (self.entries[key][0], value)
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.counters['invalidations'] += 1
+
+    def items(self):
+        """A list of (key, value) for all entries, oldest first."""
+        return [(key, entry[1]) for (key, entry) in self.entries.items()]
+
+    def clear(self):
+        self.counters['invalidations'] += len(self.entries)
+        self.entries.clear()
+
+    def stats(self):
+        result = dict(self.counters)
+        result['size'] = len(self.entries)
+        lookups = result['hits'] + result['misses']
+        result['hit_rate'] = result['hits']/lookups if lookups else 0.0
+        return result
+
+
+def update_cached_results(cache, fingerprint, word, distance):
+    """Patches the cached query results of a matcher or BKTree after
+    word was added. Keys are (kind, query, parameter, fingerprint)
+    and distance(query, word, limit) is the evaluator distance. Only
+    results that word gets into are changed; entries for other
+    penalties can not be looked up any more and are dropped."""
+    for (key, value) in cache.items():
+        (kind, query, parameter, key_fingerprint) = key
+        if key_fingerprint != fingerprint:
+            cache.remove(key)
+        elif kind == 'within':
+            dist = distance(query, word, parameter)
+            if dist <= parameter:
+                cache.replace(key, sorted(value + [(dist, word)]))
+        elif kind == 'closest':
+            dist = distance(query, word, value[0])
+            if dist < value[0]:
+                cache.replace(key, (dist, word))
+        elif kind == 'top_k':
+            top = TopK(parameter)
+            for (dist, w) in value:
+                top.offer(dist, w)
+            dist = distance(query, word, top.bound())
+            if dist <= top.bound():
+                top.offer(dist, word)
+                cache.replace(key, top.result())
+        else:
+            cache.remove(key)
+
+
+class StringPool():
+    """Strings stored without an object per string: their UTF-8 bytes
+one after another in one buffer, an array of where each one ends and
+an open addressing hash table of their ids. A string's id is its
+position and never changes. This takes the text plus 16 to 24 bytes
+per string, where a set of str objects takes 60 or more. Strings are
+decoded when they are read, so a scan pays for a decode per string.
+Hashes are CRC-32 of the bytes, so a pickled pool works in any
+process."""
+
+    def __init__(self, strings=()):
+        self.data = bytearray()
+        self.offsets = array.array('q', [0])
+        self.table = array.array('i', [-1])*8  # -1 marks a free slot
+        for s in strings:
+            self.add(s)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('String id out of range.')
+        return self.data[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+    def __iter__(self):
+        return self.decode(range(len(self)))
+
+    def __contains__(self, s):
+        return isinstance(s, str) and self.index(s) >= 0
+
+    def strings(self, ids):
+        """The strings with the given ids, as a list."""
+        return list(self.decode(ids))
+
+    def decode(self, ids):
+        """Yields the strings with the given ids."""
+        data = self.data
+        offsets = self.offsets
+        for i in ids:
+            yield data[offsets[i]:offsets[i+1]].decode('utf-8')
+
+    def probe(self, encoded):
+        """The slot of encoded in the table and its id, or the free
+        slot where it would go and -1."""
+        table = self.table
+        mask = len(table) - 1
+        slot = zlib.crc32(encoded) & mask
+        (data, offsets, size) = (self.data, self.offsets, len(encoded))
+        while True:
+            i = table[slot]
+            if i == -1:
+                return (slot, -1)
+            start = offsets[i]
+            if offsets[i+1] - start == size and data[start:start+size] == encoded:
+                return (slot, i)
+            slot = (slot + 1) & mask
+
+    def index(self, s):
+        """The id of s, or -1 if it is not in the pool."""
+        return self.probe(s.encode('utf-8'))[1]
+
+    def add(self, s):
+        """Adds s if it is not in the pool yet. Returns its id."""
+        encoded = s.encode('utf-8')
+        (slot, i) = self.probe(encoded)
+        if i != -1:
+            return i
+        return self.store(encoded, slot)
+
+    def append(self, s):
+        """Adds s even if it is in the pool already, like list.append.
+        Lookups find the first copy. Returns the new id."""
+        encoded = s.encode('utf-8')
+        (slot, i) = self.probe(encoded)
+        if i != -1:
+            slot = None
+        return self.store(encoded, slot)
+
+    def extend(self, strings):
+        for s in strings:
+            self.append(s)
+
+    def store(self, encoded, slot):
+        i = len(self)
+        self.data.extend(encoded)
+        self.offsets.append(len(self.data))
+        if slot is not None:
+            self.table[slot] = i
+            # Keep the table at most half full.
+            if 2*len(self) > len(self.table):
+                self.rehash(2*len(self.table))
+        return i
+
+    def rehash(self, size):
+        table = array.array('i', [-1])*size
+        mask = size - 1
+        (data, offsets) = (self.data, self.offsets)
+        for i in range(len(self)):
+            slot = zlib.crc32(data[offsets[i]:offsets[i+1]]) & mask
+            while table[slot] != -1:
+                slot = (slot + 1) & mask
+            table[slot] = i
+        self.table = table
+
+    def memory_footprint(self):
+        return (sys.getsizeof(self.data) + sys.getsizeof(self.offsets) +
+                sys.getsizeof(self.table))
+
+
+class MappedStringPool(StringPool):
+    """A read-only StringPool whose buffer, offsets and hash table are
+views of an index file. Strings are decoded from the file when they
+are read."""
+
+    def __init__(self, data, offsets, table):
+        self.data = data
+        self.offsets = offsets
+        self.table = table
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('String id out of range.')
+        return str(self.data[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+    def decode(self, ids):
+        data = self.data
+        offsets = self.offsets
+        for i in ids:
+            yield str(data[offsets[i]:offsets[i+1]], 'utf-8')
+
+    def store(self, encoded, slot):
+        raise TypeError('A mapped string pool is read-only.')
+
+    def rehash(self, size):
+        raise TypeError('A mapped string pool is read-only.')
+
+    def memory_footprint(self):
+        # The file is paged in by the system as needed.
+        return 0
+
+
+class StringPoolView():
+    """A sequence of the strings of a pool with the ids in an array,
+such as the words of one length or the words in sorted order.
+A view given a length holds every string of the pool that has that
+length, so testing membership needs no scan of the ids."""
+
+    def __init__(self, pool, ids, length=None):
+        self.pool = pool
+        self.ids = ids
+        self.length = length
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self.pool.strings(self.ids[k])
+        return self.pool[self.ids[k]]
+
+    def __iter__(self):
+        return self.pool.decode(self.ids)
+
+    def __contains__(self, s):
+        if self.length is not None:
+            return len(s) == self.length and self.pool.index(s) != -1
+        i = self.pool.index(s)
+        return i != -1 and i in self.ids
+
+
+class BasicWordMatcher(Instrumented):
+
+    instrumented_methods = ('add_word', 'find_within', 'find_closest',
+                            'find_top_k', 'complete', 'length_buckets',
+                            'fold_hits')
+
     def __init__(self, penalty=None, evaluator=None, allow_spaces=False):
         if penalty is None:
             self.penalties = BasicPenalties()
@@ -285,11 +1410,78 @@ class BasicWordMatcher():
             self.dev = EditDistanceEvaluator(self.penalties)
         else:
             self.dev = evaluator
-        self.words = set()
+        self.words = StringPool()
+        self.by_length = {} # length -> array of word ids
+        self.blocks = {}    # length -> WordBlock, for batch evaluators
         self.allow_spaces = allow_spaces
+        self.cache = None   # LRUCache of query results, if enabled
+        # The folded forms, for the penalties with this fingerprint,
+        # of the words that fold to something else, and those words
+        # as chains of entries: the last entry of a form, and per
+        # entry its word id and the entry before it. A word that is
+        # its own folded form is found in self.words instead. Words
+        # are folded when the index is next used, not when added.
+        self.folds = StringPool()
+        self.fold_first = array.array('i')
+        self.fold_ids = array.array('i')
+        self.fold_next = array.array('i')
+        self.folded = 0     # words looked at for the index
+        self.fold_indexed = False
+        self.fold_fingerprint = None
+        self.fold_characters = {}
+        self.fold_bound_cache = (None, None)
+        self.sorted_words = None  # for complete, built when first needed
         
     def get_penalties(self):
         return self.penalties
+
+    def stats_parts(self):
+        return [('evaluator', self.dev)]
+
+    def memory_footprint(self):
+        self.folding()
+        size = self.words.memory_footprint() + self.folds.memory_footprint()
+        size += sys.getsizeof(self.fold_first) + sys.getsizeof(self.fold_ids) + \
+            sys.getsizeof(self.fold_next)
+        size += shallow_size(self.by_length)
+        if self.sorted_words is not None:
+            size += sys.getsizeof(self.sorted_words.ids)
+        return size
+
+    def count(self, candidates, verified):
+        """Adds to the candidate counters, if stats are on."""
+        if self.stats_counters is not None:
+            self.stats_counters['candidates'] += candidates
+            self.stats_counters['verified'] += verified
+
+    def enable_cache(self, max_size=1024, ttl=None):
+        """Keeps the results of up to max_size queries, for at most
+        ttl seconds if ttl is given. Adding a word patches the cached
+        results it changes. The counters are in self.cache.stats()."""
+        self.cache = LRUCache(max_size, ttl)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def cache_get(self, kind, query, parameter):
+        """The cached result for a normalized query, or None."""
+        if self.cache is None:
+            return None
+        key = (kind, query, parameter, self.dev.penalties.fingerprint())
+        result = self.cache.get(key)
+        if isinstance(result, list):
+            result = list(result)
+        return result
+
+    def cache_put(self, kind, query, parameter, result):
+        """Caches result, if caching is enabled, and returns it."""
+        if self.cache is not None:
+            key = (kind, query, parameter, self.dev.penalties.fingerprint())
+            if isinstance(result, list):
+                self.cache.put(key, list(result))
+            else:
+                self.cache.put(key, result)
+        return result
         
     def size(self):
         return len(self.words)
@@ -303,35 +1495,558 @@ class BasicWordMatcher():
         if not self.allow_spaces and ' ' in word:
             raise TypeError('Argument is not a single word.')
 
+    def normalize_query(self, word):
+        """The form of a query that is compared against the words."""
+        return word
+
+    def save(self, filename):
+        """Writes the words to an index file for load_words or
+        load_word_matcher."""
+        write_index(filename, INDEX_WORDS, self.words, self.get_penalties(),
+                    buckets=self.by_length)
+
+    def session(self, max_error):
+        """Starts an incremental QuerySession for type-ahead queries."""
+        return QuerySession(self, max_error)
+
     def add_word(self, word):
         self.check_single_word(word)
-        self.words.add(word)
+        count = len(self.words)
+        word_id = self.words.add(word)
+        if word_id < count:
+            return
+        length = len(word)
+        if length in self.by_length:
+            self.by_length[length].append(word_id)
+        else:
+            self.by_length[length] = array.array('i', [word_id])
+        self.blocks.pop(length, None)
+        # Sorted again by the next complete.
+        self.sorted_words = None
+        if self.cache is not None:
+            update_cached_results(self.cache, self.dev.penalties.fingerprint(),
+                                  word, self.dev.distance)
+
+    def uses_batches(self):
+        return isinstance(self.dev, BatchEditDistanceEvaluator)
+
+    def fold_state(self):
+        """Drops the index of folded forms when the groups of the
+        penalties have changed, since folding depends on them."""
+        fingerprint = self.dev.penalties.fingerprint()
+        if fingerprint != self.fold_fingerprint:
+            self.fold_fingerprint = fingerprint
+            self.fold_characters = {}
+            self.fold_bound_cache = (None, None)
+            self.folds = StringPool()
+            self.fold_first = array.array('i')
+            self.fold_ids = array.array('i')
+            self.fold_next = array.array('i')
+            self.folded = 0
+            self.fold_indexed = self.fold_index_needed()
+
+    def fold_index_needed(self):
+        """Whether a word other than the query itself can be closer
+        to it than fold_bound(). If no swap is that cheap, as with
+        no groups, the fold shortcuts need no index."""
+        return self.dev.penalties.min_swap_cost() < self.fold_bound()
+
+    def folding(self):
+        """Brings the index of folded forms up to date, if there is
+        one: folds the words added since it was last used."""
+        self.fold_state()
+        if self.fold_indexed and self.folded < len(self.words):
+            ids = range(self.folded, len(self.words))
+            for (word_id, w) in zip(ids, self.words.decode(ids)):
+                self.fold_word(word_id, w)
+            self.folded = len(self.words)
+
+    def fold_word(self, word_id, word):
+        """Adds a word to the index of folded forms, unless it is
+        its own folded form."""
+        key = self.fold(word)
+        if key == word:
+            return
+        fold_id = self.folds.add(key)
+        if fold_id == len(self.fold_first):
+            self.fold_first.append(-1)
+        self.fold_ids.append(word_id)
+        self.fold_next.append(self.fold_first[fold_id])
+        self.fold_first[fold_id] = len(self.fold_ids) - 1
+
+    def folded_words(self, key):
+        """The words whose folded form is key. Builds the index of
+        folded forms if it was skipped."""
+        self.fold_state()
+        self.fold_indexed = True
+        self.folding()
+        ids = []
+        word_id = self.words.index(key)
+        if word_id != -1 and self.fold(key) == key:
+            ids.append(word_id)
+        fold_id = self.folds.index(key)
+        entry = self.fold_first[fold_id] if fold_id != -1 else -1
+        while entry != -1:
+            ids.append(self.fold_ids[entry])
+            entry = self.fold_next[entry]
+        return self.words.strings(ids)
+
+    def fold_character(self, character):
+        folded = self.fold_characters.get(character)
+        if folded is None:
+            groups = getattr(self.dev.penalties, 'groups', None)
+            folded = fold_character(character, groups)
+            self.fold_characters[character] = folded
+        return folded
+
+    def fold(self, word):
+        """The canonical form of word, with accents removed and
+        group members replaced by their base, in lower case."""
+        return ''.join([self.fold_character(c) for c in word])
+
+    def fold_bound(self):
+        """A word that does not fold like a query is at least this far
+        from it: it takes an add, a drop, a transposition or a swap
+        between characters that fold differently."""
+        table = self.dev.get_compiled()
+        self.fold_state()
+        if self.fold_bound_cache[0] is not table:
+            swap = self.dev.penalties.min_swap_cost(self.fold_character)
+            bound = min(table.min_add_penalty, table.drop_penalty,
+                        table.transpose_penalty, swap)
+            self.fold_bound_cache = (table, bound)
+        return self.fold_bound_cache[1]
+
+    def fold_hits(self, word):
+        """(distance, word) for the words that fold like word, or
+        just word if there is no index and it is a word."""
+        self.folding()
+        if self.fold_indexed:
+            hits = self.folded_words(self.fold(word))
+        else:
+            hits = [word] if word in self.words else []
+        return [(self.dev.distance(word, w), w) for w in hits]
+
+    def get_block(self, length):
+        """The words of one length encoded for the batch evaluator."""
+        block = self.blocks.get(length)
+        if block is None or block.table is not self.dev.get_compiled():
+            block = self.dev.prepare(self.bucket(length))
+            self.blocks[length] = block
+        return block
 
     def find_closest(self, word):
         self.check_string(word)
+        word = self.normalize_query(word)
         
         if len(self.words) == 0:
             return ('', self.dev.distance(word, ''))
+        closest = self.closest_shortcut(word)
+        if closest is not None:
+            return closest
 
-        min_penalty = 1000000000000
+        min_penalty = OVER_LIMIT
         closest = ''
 
-        for w in self.words:
-            dist = self.dev.distance(word, w)
-            if dist < min_penalty:
-                min_penalty = dist
-                closest = w
+        # Every word is only computed as far as it
+        # can still beat the best one found so far.
+        for (bound, length, bucket) in self.length_buckets(word):
+            if bound >= min_penalty:
+                break
+            if self.uses_batches():
+                block = self.get_block(length)
+                dists = self.dev.distances(word, block, min_penalty)
+                dist = min(dists)
+                if dist < min_penalty:
+                    min_penalty = dist
+                    closest = block.words[dists.index(dist)]
+                    if min_penalty <= 0:
+                        break
+                continue
+            for w in self.bucket_order(word, bucket):
+                dist = self.dev.distance(word, w, min_penalty)
+                if dist < min_penalty:
+                    min_penalty = dist
+                    closest = w
+                    if min_penalty <= 0:
+                        return self.cache_put('closest', word, None,
+                                              (min_penalty, closest))
 
-        return (min_penalty, closest)
+        return self.cache_put('closest', word, None, (min_penalty, closest))
+
+    def closest_shortcut(self, word):
+        """find_closest of a normalized query from the cache or the
+        folded forms, or None if the words have to be searched."""
+        cached = self.cache_get('closest', word, None)
+        if cached is not None:
+            return cached
+        # Accent-only mistakes are answered by the folded forms.
+        hits = self.fold_hits(word)
+        if hits:
+            best = min(hits)
+            if best[0] <= self.fold_bound():
+                return self.cache_put('closest', word, None, best)
+        return None
+
+    def fold_within(self, word, max_error):
+        """find_within of a normalized query for a max_error below
+        fold_bound(): only words that fold like it can be close
+        enough."""
+        within = [m for m in self.fold_hits(word) if m[0] <= max_error]
+        return self.cache_put('within', word, max_error, sort_by_distance(within))
+
+    def length_buckets(self, word, max_error=OVER_LIMIT):
+        """Returns a list of (bound, length, words) for the words of every
+        length that can be within max_error of word, lowest bound first.
+        The bound is the smallest distance any of the words can have."""
+        table = self.dev.get_compiled()
+        length = len(word)
+        buckets = []
+        for bucket_length in self.by_length:
+            bound = table.length_bound(length, bucket_length)
+            if bound <= max_error:
+                buckets.append((bound, abs(bucket_length - length),
+                                bucket_length, self.bucket(bucket_length)))
+        buckets.sort(key=(lambda x : x[:3]))
+        return [(b[0], b[2], b[3]) for b in buckets]
+
+    def bucket(self, length):
+        """The words of one length."""
+        return StringPoolView(self.words, self.by_length[length], length)
+
+    def bucket_order(self, word, bucket):
+        """Yields the words of a bucket, the word itself first
+        and then the ones that share its first letter."""
+        if word in bucket:
+            yield word
+        first = word[:1]
+        others = []
+        for w in bucket:
+            if w == word:
+                continue
+            if w[:1] == first:
+                yield w
+            else:
+                others.append(w)
+        for w in others:
+            yield w
+
+    def scan_order(self, word):
+        """Yields all words so that likely close matches come first:
+        the word itself, then by growing length bound with words
+        that share the first letter before others."""
+        for (bound, length, bucket) in self.length_buckets(word):
+            for w in self.bucket_order(word, bucket):
+                yield w
     
     def find_within(self, word, max_error):
+        self.check_string(word)
+        word = self.normalize_query(word)
+        cached = self.cache_get('within', word, max_error)
+        if cached is not None:
+            return cached
+        if max_error < self.fold_bound():
+            return self.fold_within(word, max_error)
         within = []
-        for w in self.words:
-            dist = self.dev.distance(word, w)
-            if dist <= max_error:
-                within.append((dist, w))
-        within.sort(key=(lambda x : x[0]))
-        return within
+        buckets = self.length_buckets(word, max_error)
+        for (bound, length, bucket) in buckets:
+            if self.uses_batches():
+                block = self.get_block(length)
+                dists = self.dev.distances(word, block, max_error)
+                for (dist, w) in zip(dists, block.words):
+                    if dist <= max_error:
+                        within.append((dist, w))
+                continue
+            for w in bucket:
+                dist = self.dev.distance(word, w, max_error)
+                if dist <= max_error:
+                    within.append((dist, w))
+        if self.stats_counters is not None:
+            scanned = sum([len(b[2]) for b in buckets])
+            self.count(scanned, scanned)
+        return self.cache_put('within', word, max_error, sort_by_distance(within))
+
+    def find_top_k(self, word, k):
+        """The k closest words as a list of (distance, word), closest
+        first and equal distances ordered by word. The k-th distance
+        found so far bounds the rest of the search."""
+        self.check_string(word)
+        word = self.normalize_query(word)
+        top = TopK(k)
+        if k <= 0:
+            return []
+        cached = self.cache_get('top_k', word, k)
+        if cached is not None:
+            return cached
+        for (bound, length, bucket) in self.length_buckets(word):
+            if bound > top.bound():
+                break
+            if self.uses_batches():
+                block = self.get_block(length)
+                dists = self.dev.distances(word, block, top.bound())
+                for (dist, w) in zip(dists, block.words):
+                    top.offer(dist, w)
+                continue
+            for w in self.bucket_order(word, bucket):
+                top.offer(self.dev.distance(word, w, top.bound()), w)
+        return self.cache_put('top_k', word, k, top.result())
+
+    def sorted_view(self):
+        """The words in sorted order."""
+        words = self.words
+        ids = sorted(range(len(words)), key=words.__getitem__)
+        return StringPoolView(words, array.array('i', ids))
+
+    def prefix_range(self, prefix, low=0, high=None):
+        """The range of sorted_words that start with prefix, searched
+        for between low and high."""
+        words = self.sorted_words
+        if high is None:
+            high = len(words)
+        start = bisect.bisect_left(words, prefix, low, high)
+        if not prefix:
+            return (start, high)
+        last = ord(prefix[-1])
+        if last == sys.maxunicode:
+            end = start
+            while end < high and words[end].startswith(prefix):
+                end += 1
+        else:
+            end = bisect.bisect_left(words, prefix[:-1] + chr(last + 1), start, high)
+        return (start, end)
+
+    def complete(self, prefix, max_error=0, limit=None):
+        """Words that start with prefix, or with something within
+        max_error of it, as a list of (distance, word) sorted by distance
+        and then word. The distance is the smallest distance from prefix
+        to a beginning of the word. At most limit words are returned.
+        Exact completion is a binary search over the sorted words;
+        fuzzy completion walks the ranges of words that share a
+        beginning and stops where the distance columns get too large."""
+        self.check_string(prefix)
+        prefix = self.normalize_query(prefix)
+        if self.sorted_words is None:
+            self.sorted_words = self.sorted_view()
+        if limit is None:
+            limit = len(self.sorted_words)
+        if limit <= 0 or max_error < 0 or len(self.sorted_words) == 0:
+            return []
+        table = self.dev.get_compiled()
+        if table.free_identity and max_error < table.min_operation_penalty:
+            # No edit is cheap enough, so only exact prefixes match.
+            (start, end) = self.prefix_range(prefix)
+            return [(0, w) for w in self.sorted_words[start:min(end, start+limit)]]
+        top = TopK(limit)
+        for (dist, start, end) in self.complete_ranges(prefix, max_error, top):
+            for w in self.sorted_words[start:min(end, start+limit)]:
+                top.offer(dist, w)
+        return top.result()
+
+    def complete_ranges(self, prefix, max_error, top):
+        """Yields (distance, start, end) for ranges of sorted_words that
+        complete prefix at that distance. The words of a range share a
+        beginning, which is extended one character at a time like a path
+        in a trie, with one distance column per character. Ranges come
+        in word order, so once top is full a word needs a smaller
+        distance than its bound to get in."""
+        words = self.sorted_words
+        table = self.dev.get_compiled()
+        s = table.encode(prefix)
+        l1 = len(s)
+        column = self.dev.first_column(table, l1)
+        # (start, end, j, columns j-2 and j-1, smallest distance to a
+        # beginning so far, code of character j-1)
+        stack = [(0, len(words), 0, None, column, column[l1], -1)]
+        while stack:
+            (start, end, j, previous2, column, best, before_code) = stack.pop()
+            if top.bound() <= max_error:
+                accept = lambda d : d < top.bound()
+            else:
+                accept = lambda d : d <= max_error
+            # Two columns over the limit, see next_column.
+            lowest = min(column)
+            if previous2 is not None:
+                lowest = min(lowest, min(previous2))
+            if accept(best) and lowest >= best:
+                yield (best, start, end)
+                continue
+            if not accept(lowest):
+                continue
+            if start < end and len(words[start]) == j:
+                if accept(best):
+                    yield (best, start, start+1)
+                start += 1
+            children = []
+            while start < end:
+                beginning = words[start][:j+1]
+                (start, child_end) = self.prefix_range(beginning, start, end)
+                code = table.index(beginning[j])
+                child = self.dev.next_column(table, s, previous2, column,
+                                             code, before_code, j+1)
+                children.append((start, child_end, j+1, column, child,
+                                 min(best, child[l1]), code))
+                start = child_end
+            children.reverse()
+            stack.extend(children)
+
+    def group_queries(self, queries, block_size):
+        """Checks and normalizes queries. Returns a dict from every
+        distinct normalized query to the queries as given, and the
+        normalized queries in blocks of at most block_size queries
+        of the same length."""
+        forms = {}
+        for q in queries:
+            self.check_string(q)
+            normalized = self.normalize_query(q)
+            if normalized not in forms:
+                forms[normalized] = [q]
+            elif q not in forms[normalized]:
+                forms[normalized].append(q)
+        by_length = {}
+        for normalized in forms:
+            by_length.setdefault(len(normalized), []).append(normalized)
+        blocks = []
+        for length in sorted(by_length):
+            group = sorted(by_length[length])
+            for i in range(0, len(group), block_size):
+                blocks.append(group[i:i+block_size])
+        return (forms, blocks)
+
+    def find_within_many(self, queries, max_error, block_size=256):
+        """Yields (query, matches) for every distinct query, as
+        find_within would give them. Queries of the same length are
+        answered together in blocks, so the words are walked and
+        decoded once per block and compared with each query in turn.
+        The pairs come grouped by query length, not in the order of
+        queries."""
+        (forms, blocks) = self.group_queries(queries, block_size)
+        for block in blocks:
+            for (normalized, matches) in self.within_block(block, max_error):
+                for q in forms[normalized]:
+                    yield (q, list(matches))
+
+    def find_closest_many(self, queries, block_size=256):
+        """Yields (query, (distance, word)) for every distinct query,
+        as find_closest would give them, in blocks like
+        find_within_many."""
+        (forms, blocks) = self.group_queries(queries, block_size)
+        for block in blocks:
+            for (normalized, closest) in self.closest_block(block):
+                for q in forms[normalized]:
+                    yield (q, closest)
+
+    def scans_words(self):
+        # Subclasses with their own index answer
+        # each query of a block with the index.
+        return type(self).find_within is BasicWordMatcher.find_within
+
+    def within_block(self, block, max_error):
+        """find_within for normalized queries of the same length. The
+        outer loop is over the words, so each word is decoded once
+        and the evaluator keeps the encodings of the queries. The
+        batch evaluator already takes a whole bucket per call, so
+        with it the queries are the outer loop."""
+        if not self.scans_words():
+            return [(q, self.find_within(q, max_error)) for q in block]
+        # Queries answered by the cache or the folded forms,
+        # like find_within does it.
+        answered = {}
+        for q in block:
+            cached = self.cache_get('within', q, max_error)
+            if cached is not None:
+                answered[q] = cached
+            elif max_error < self.fold_bound():
+                answered[q] = self.fold_within(q, max_error)
+        if answered:
+            rest = [q for q in block if q not in answered]
+            if rest:
+                answered.update(self.within_block(rest, max_error))
+            return [(q, answered[q]) for q in block]
+        within = dict([(q, []) for q in block])
+        found = [within[q] for q in block]
+        distance = self.dev.distance
+        for (bound, length, bucket) in self.length_buckets(block[0], max_error):
+            if self.uses_batches():
+                words = self.get_block(length)
+                for q in block:
+                    dists = self.dev.distances(q, words, max_error)
+                    within[q].extend([(dist, w) for (dist, w) in zip(dists, words.words)
+                                      if dist <= max_error])
+                continue
+            for w in bucket:
+                for k in range(len(block)):
+                    dist = distance(block[k], w, max_error)
+                    if dist <= max_error:
+                        found[k].append((dist, w))
+        return [(q, self.cache_put('within', q, max_error, sort_by_distance(within[q])))
+                for q in block]
+
+    def closest_block(self, block):
+        """find_closest for normalized queries of the same length.
+        The length buckets are the same for all of them, and a bucket
+        is only walked for the queries it can still improve, with the
+        words in the outer loop like within_block. Words equal to a
+        query come first and then the ones that share a first letter
+        with one, so the bounds drop early. find_closest keeps the
+        first best word in bucket_order, so within a bucket a tie goes
+        to the word that bucket_order puts first for the query."""
+        if not self.scans_words() or len(self.words) == 0:
+            return [(q, self.find_closest(q)) for q in block]
+        answered = {}
+        for q in block:
+            shortcut = self.closest_shortcut(q)
+            if shortcut is not None:
+                answered[q] = shortcut
+        if answered:
+            rest = [q for q in block if q not in answered]
+            if rest:
+                answered.update(self.closest_block(rest))
+            return [(q, answered[q]) for q in block]
+        closest = dict([(q, (OVER_LIMIT, '')) for q in block])
+        distance = self.dev.distance
+        for (bound, length, bucket) in self.length_buckets(block[0]):
+            active = [q for q in block if bound < closest[q][0]]
+            if not active:
+                break
+            if self.uses_batches():
+                words = self.get_block(length)
+                for q in active:
+                    dists = self.dev.distances(q, words, closest[q][0])
+                    dist = min(dists)
+                    if dist < closest[q][0]:
+                        closest[q] = (dist, words.words[dists.index(dist)])
+                continue
+            words = list(bucket)
+            queries = set(active)
+            firsts = set([q[:1] for q in active])
+            order = [p for p in range(len(words)) if words[p] in queries]
+            order += [p for p in range(len(words)) if words[p] not in queries
+                      and words[p][:1] in firsts]
+            order += [p for p in range(len(words)) if words[p][:1] not in firsts]
+            # Per active query: best distance, its word and its place
+            # in bucket_order as (0 for the query itself, 1 for a word
+            # with the same first letter or 2, position). A word from
+            # an earlier bucket wins ties.
+            best = [[closest[q][0], closest[q][1], (-1, -1)] for q in active]
+            for p in order:
+                w = words[p]
+                for k in range(len(active)):
+                    q = active[k]
+                    current = best[k]
+                    dist = distance(q, w, current[0])
+                    if dist > current[0]:
+                        continue
+                    if w == q:
+                        place = (0, p)
+                    elif w[:1] == q[:1]:
+                        place = (1, p)
+                    else:
+                        place = (2, p)
+                    if dist < current[0] or place < current[2]:
+                        best[k] = [dist, w, place]
+            for (q, (dist, w, place)) in zip(active, best):
+                closest[q] = (dist, w)
+        return [(q, self.cache_put('closest', q, None, closest[q])) for q in block]
 
 class CaseInsensitiveWordMatcher(BasicWordMatcher):
 
@@ -342,56 +2057,1605 @@ class CaseInsensitiveWordMatcher(BasicWordMatcher):
         self.check_string(word)
         super(CaseInsensitiveWordMatcher, self).add_word(word.lower())
         
+    def normalize_query(self, word):
+        return word.lower()
+
+
+class QuerySession():
+    """A query that is typed one character at a time.
+
+For every candidate word the session keeps the part of the distance
+matrix that does not depend on the rest of the query: all rows, and
+the columns up to the query length (after that the end add penalty
+applies). Typing a character adds one row and one column, backspace
+removes them. Candidates that can no longer get within max_error
+whatever is typed next are dropped, so the work per keystroke depends
+on the surviving candidates, not on the size of the word list.
+
+The session uses the penalties as they were when it was started and
+the words that were in the matcher at that time."""
+
+    def __init__(self, matcher, max_error):
+        self.matcher = matcher
+        self.dev = matcher.dev
+        self.table = self.dev.get_compiled()
+        self.max_error = max_error
+        self.query = ''
+        self.codes = []
+        self.states = {}
+        for w in matcher.words:
+            self.states[w] = (self.table.encode(w), [[0]])
+        self.frames = [list(self.states)]
+
+    def candidates(self):
+        """The number of words that are still considered."""
+        return len(self.frames[-1])
+
+    def set_query(self, query):
+        """Moves to a new query, keeping the common prefix."""
+        self.matcher.check_string(query)
+        query = self.matcher.normalize_query(query)
+        common = 0
+        limit = min(len(query), len(self.query))
+        while common < limit and query[common] == self.query[common]:
+            common += 1
+        self.backspace(len(self.query) - common)
+        self.append(query[common:])
+
+    def append(self, text):
+        self.matcher.check_string(text)
+        for c in self.matcher.normalize_query(text):
+            self.__append_character(c)
+
+    def backspace(self, count=1):
+        for k in range(min(count, len(self.query))):
+            for w in self.frames.pop():
+                self.__shrink(self.states[w][1])
+            self.query = self.query[:-1]
+            self.codes.pop()
+
+    def results(self):
+        """The candidates within max_error of the current query,
+        sorted like BasicWordMatcher.find_within."""
+        within = []
+        for w in self.frames[-1]:
+            (codes, block) = self.states[w]
+            dist = self.__distance(codes, block)
+            if dist <= self.max_error:
+                within.append((dist, w))
+        return sort_by_distance(within)
+
+    def __append_character(self, c):
+        self.query += c
+        self.codes.append(self.table.index(c))
+        survivors = []
+        for w in self.frames[-1]:
+            (codes, block) = self.states[w]
+            self.__grow(codes, block)
+            if self.__bound(codes, block) > self.max_error:
+                self.__shrink(block)
+            else:
+                survivors.append(w)
+        self.frames.append(survivors)
+
+    def __grow(self, codes, block):
+        table = self.table
+        costs = table.costs
+        swap = table.swap_penalty
+        drop = table.drop_penalty
+        add = table.add_penalty
+        transpose = table.transpose_penalty
+        s = self.codes
+        i = len(block)
+        width = len(block[0]) - 1
+        # The new row. All of its columns are within the
+        # query length, so the plain add penalty applies.
+        source_code = s[i-1]
+        above = block[i-1]
+        above2 = block[i-2] if i >= 2 else None
+        row = [i*drop]
+        for j in range(1, width+1):
+            target_code = codes[j-1]
+            total_penalty = above[j-1] + costs[source_code].get(target_code, swap)
+            del_penalty = above[j] + drop
+            if del_penalty < total_penalty:
+                total_penalty = del_penalty
+            add_penalty = row[j-1] + add
+            if add_penalty < total_penalty:
+                total_penalty = add_penalty
+            if i >= 2 and j >= 2 and source_code == codes[j-2] and \
+                    s[i-2] == target_code:
+                transpose_penalty = above2[j-2] + transpose
+                if transpose_penalty < total_penalty:
+                    total_penalty = transpose_penalty
+            row.append(total_penalty)
+        block.append(row)
+        # The new column, unless the word has ended already.
+        j = width + 1
+        if j > len(codes):
+            return
+        target_code = codes[j-1]
+        block[0].append(j*add)
+        for i in range(1, len(block)):
+            source_code = s[i-1]
+            total_penalty = block[i-1][j-1] + costs[source_code].get(target_code, swap)
+            del_penalty = block[i-1][j] + drop
+            if del_penalty < total_penalty:
+                total_penalty = del_penalty
+            add_penalty = block[i][j-1] + add
+            if add_penalty < total_penalty:
+                total_penalty = add_penalty
+            if i >= 2 and j >= 2 and source_code == codes[j-2] and \
+                    s[i-2] == target_code:
+                transpose_penalty = block[i-2][j-2] + transpose
+                if transpose_penalty < total_penalty:
+                    total_penalty = transpose_penalty
+            block[i].append(total_penalty)
+
+    def __shrink(self, block):
+        block.pop()
+        if len(block[0]) > len(block):
+            for row in block:
+                row.pop()
+
+    def __bound(self, codes, block):
+        # Any path to the last cell, for this query or a longer one,
+        # crosses one of the last two rows or, if the word goes on,
+        # one of the last two columns.
+        bound = min(block[-1])
+        if len(block) >= 2:
+            bound = min(bound, min(block[-2]))
+        width = len(block[0]) - 1
+        if width < len(codes):
+            for row in block:
+                bound = min(bound, row[width])
+                if width >= 1:
+                    bound = min(bound, row[width-1])
+        return bound
+
+    def __distance(self, codes, block):
+        width = len(block[0]) - 1
+        if width == len(codes):
+            return block[-1][width]
+        # The rest of the word is past the end of the query,
+        # where it is always the end add penalty.
+        previous = [row[width] for row in block]
+        if width >= 1:
+            previous2 = [row[width-1] for row in block]
+        else:
+            previous2 = None
+        previous_min = min(previous)
+        for j in range(width+1, len(codes)+1):
+            if j >= 2:
+                before_code = codes[j-2]
+            else:
+                before_code = -1
+            column = self.dev.next_column(self.table, self.codes, previous2,
+                                          previous, codes[j-1], before_code, j)
+            column_min = min(column)
+            if column_min > self.max_error and previous_min > self.max_error:
+                return OVER_LIMIT
+            previous2 = previous
+            previous = column
+            previous_min = column_min
+        return previous[-1]
+
+
+class TrieNode():
+    def __init__(self):
+        self.children = {}
+        self.word = None  # word id
+
+
+class TrieWordMatcher(BasicWordMatcher):
+    """A matcher that keeps its words in a character trie. A query
+walks the trie depth first and computes one distance matrix column
+per node, so words with a common prefix share those columns. A
+subtree is skipped once its columns are over the bound."""
+
+    def __init__(self, penalty=None, evaluator=None, allow_spaces=False):
+        super(TrieWordMatcher, self).__init__(penalty, evaluator, allow_spaces)
+        self.root = TrieNode()
+
+    def add_word(self, word):
+        if word in self.words:
+            return
+        super(TrieWordMatcher, self).add_word(word)
+        node = self.root
+        for c in word:
+            child = node.children.get(c)
+            if child is None:
+                child = TrieNode()
+                node.children[c] = child
+            node = child
+        node.word = len(self.words) - 1
+
     def find_closest(self, word):
         self.check_string(word)
-        return super(CaseInsensitiveWordMatcher, self).find_closest(word.lower())
+        word = self.normalize_query(word)
+
+        if len(self.words) == 0:
+            return ('', self.dev.distance(word, ''))
+
+        min_penalty = OVER_LIMIT
+        closest = ''
+        # Children that continue the query are pushed last, so
+        # they are visited first and give a low bound early.
+        for (dist, w) in self.walk(word, lambda : min_penalty, True, word):
+            if dist < min_penalty:
+                min_penalty = dist
+                closest = w
+                if min_penalty <= 0:
+                    break
+        return (min_penalty, closest)
+
+    def find_within(self, word, max_error):
+        self.check_string(word)
+        word = self.normalize_query(word)
+        within = []
+        for (dist, w) in self.walk(word, lambda : max_error, False):
+            if dist <= max_error:
+                within.append((dist, w))
+        return sort_by_distance(within)
+
+    def find_top_k(self, word, k):
+        self.check_string(word)
+        word = self.normalize_query(word)
+        top = TopK(k)
+        if k <= 0:
+            return []
+        for (dist, w) in self.walk(word, top.bound, False, word):
+            top.offer(dist, w)
+        return top.result()
+
+    def walk(self, word, bound, strict, guide=None):
+        """Yields (distance, word) for the words of the trie, skipping
+        subtrees that can only hold words over bound(), which is called
+        again before every node. If strict is true, words at exactly
+        the bound may be skipped too. If guide is given, children that
+        follow it are visited first."""
+        table = self.dev.get_compiled()
+        s = table.encode(word)
+        l1 = len(s)
+        column = self.dev.first_column(table, l1)
+        if self.root.word is not None:
+            yield (column[l1], self.words[self.root.word])
+        stack = []
+        self.__push_children(stack, self.root, 1, None, column,
+                             min(column), -1, guide)
+        while stack:
+            (node, c, j, previous2, previous, previous_min, before_code) = \
+                stack.pop()
+            code = table.index(c)
+            column = self.dev.next_column(table, s, previous2, previous,
+                                          code, before_code, j)
+            if node.word is not None:
+                yield (column[l1], self.words[node.word])
+            column_min = min(column)
+            # Two columns over the bound, see next_column.
+            limit = bound()
+            if strict:
+                if column_min >= limit and previous_min >= limit:
+                    continue
+            elif column_min > limit and previous_min > limit:
+                continue
+            self.__push_children(stack, node, j+1, previous, column,
+                                 column_min, code, guide)
+
+    def __push_children(self, stack, node, j, previous2, previous,
+                        previous_min, before_code, guide):
+        preferred = None
+        if guide is not None and j <= len(guide):
+            preferred = guide[j-1]
+        for (c, child) in node.children.items():
+            if c != preferred:
+                stack.append((child, c, j, previous2, previous,
+                              previous_min, before_code))
+        if preferred in node.children:
+            stack.append((node.children[preferred], preferred, j, previous2,
+                          previous, previous_min, before_code))
 
 
 # Classic Burkhard-Keller Tree. This only works on
 # metrics. Damerau-Levenshtein is _not_ a metric. 
 # Plain Levenshtein is.
 
-class BKTree():
+class BKTree(Instrumented):
+    """Nodes are kept in parallel arrays instead of node objects:
+node n holds self.words[n], its first child, its next sibling and
+the distance to its parent. Insertion and search use loops and an
+explicit stack, so deep trees do not hit the recursion limit."""
+
+    instrumented_methods = ('add_word', 'bulk_build', 'find', 'find_top_k')
 
     def __init__(self, distance_function):
         self.distance = distance_function
-        self.root = None
+        self.words = StringPool()  # node -> word
+        self.first_child = array.array('i')
+        self.next_sibling = array.array('i')
+        self.edge = array.array('d')
+        self.cache = None   # LRUCache of query results, if enabled
 
-    def add_word(self, word):
-        if self.root is None:
-            self.root = BKNode(word)
+    def enable_cache(self, max_size=1024, ttl=None):
+        """Like BasicWordMatcher.enable_cache."""
+        self.cache = LRUCache(max_size, ttl)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def stats_parts(self):
+        return [('evaluator', self.distance)]
+
+    def memory_footprint(self):
+        return (self.words.memory_footprint() + sys.getsizeof(self.first_child) +
+                sys.getsizeof(self.next_sibling) + sys.getsizeof(self.edge))
+
+    def count_nodes(self, visited, seen):
+        """Adds the nodes a search visited and the ones it pruned: of the
+        seen children of visited nodes, those that were not visited."""
+        if self.stats_counters is not None:
+            self.stats_counters['nodes_visited'] += visited
+            self.stats_counters['nodes_pruned'] += seen + 1 - visited
+
+    def cache_key(self, kind, query, parameter):
+        return (kind, query, parameter, self.distance.penalties.fingerprint())
+
+    def word_added(self, word):
+        if self.cache is not None:
+            update_cached_results(self.cache, self.distance.penalties.fingerprint(),
+                                  word, self.distance.distance)
+
+    def size(self):
+        return len(self.words)
+
+    def save(self, filename):
+        """Writes the tree to an index file for load_bktree."""
+        write_index(filename, INDEX_BKTREE, self.words, self.distance.penalties,
+                    nodes=(self.first_child, self.next_sibling, self.edge))
+
+    def bulk_build(self, words, workers=None, sample_size=8):
+        """Adds many words at once. Every node is chosen from a sample of
+        its words as the one that spreads the sample over the most
+        distances. The top of the tree is built here until there are
+        subtrees enough for the workers, and the subtrees are built in
+        a pool of worker processes (one per CPU if workers is None).
+        The result can be searched exactly like a tree built with
+        add_word. Without more than one worker, or for a tree that
+        already has words, the words are added one by one."""
+        words = list(words)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if self.words or workers <= 1 or len(words) < 2*sample_size:
+            for w in words:
+                self.add_word(w)
             return
-        current = self.root
-        self.__add_recursively(current, word)
+        jobs = self.split_jobs(words, workers, sample_size)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = []
+            for (parent, d, group) in jobs:
+                results.append((parent, executor.submit(
+                    build_bktree_partition, self.distance, d, group, sample_size)))
+            for (parent, result) in results:
+                self.graft(parent, result.result())
+
+    def split_jobs(self, words, workers, sample_size):
+        """Builds the top of the tree for bulk_build and returns the
+        subtrees left to build as a list of (parent, distance, words).
+        The largest subtree is split further as long as there are fewer
+        subtrees than workers or it holds more than its share of the
+        words, largest first."""
+        root = self.__new_node(self.pick_pivot(words, sample_size), 0)
+        # A heap of (-size, order, parent, distance, words).
+        heap = []
+        for (d, group) in self.partition(words, self.words[root]):
+            heap.append((-len(group), len(heap), root, d, group))
+        heapq.heapify(heap)
+        order = len(heap)
+        share = len(words) // workers
+        while heap and (len(heap) < workers or -heap[0][0] > share):
+            (size, _, parent, distance, group) = heap[0]
+            if -size < 2*sample_size:
+                break
+            heapq.heappop(heap)
+            node = self.__new_node(self.pick_pivot(group, sample_size), distance)
+            self.next_sibling[node] = self.first_child[parent]
+            self.first_child[parent] = node
+            for (d, child) in self.partition(group, self.words[node]):
+                heapq.heappush(heap, (-len(child), order, node, d, child))
+                order += 1
+        return [(parent, d, group) for (_, _, parent, d, group) in sorted(heap)]
+
+    def pick_pivot(self, words, sample_size):
+        """Picks the word of a random sample whose distances to the
+        rest of the sample take the most distinct values, so that it
+        splits the words into many small subtrees."""
+        if len(words) < 4*sample_size:
+            return words[0]
+        sample = random.Random(len(words)).sample(words, sample_size)
+        best = None
+        for candidate in sample:
+            distances = [self.distance.distance(candidate, w) for w in sample]
+            score = (len(set(distances)), -sum(distances))
+            if best is None or score > best[0]:
+                best = (score, candidate)
+        return best[1]
+
+    def partition(self, words, pivot):
+        """Groups words by their distance to pivot, as a list of
+        (distance, words). Words equal to the pivot are left out."""
+        groups = {}
+        for w in words:
+            d = self.distance.distance(w, pivot)
+            if d == 0:
+                continue
+            if d in groups:
+                groups[d].append(w)
+            else:
+                groups[d] = [w]
+        return sorted(groups.items())
 
-    def __add_recursively(self, node, word):
-        distance = self.distance.distance(word, node.word)
-        if distance == 0:
+    def build_subtree(self, parent, distance, words, sample_size):
+        """Builds a subtree of words below node parent (-1 for
+        the root) with an explicit stack."""
+        stack = [(parent, distance, words)]
+        while stack:
+            (parent, distance, words) = stack.pop()
+            pivot = self.pick_pivot(words, sample_size)
+            node = self.__new_node(pivot, distance)
+            if parent != -1:
+                self.next_sibling[node] = self.first_child[parent]
+                self.first_child[parent] = node
+            for (d, group) in self.partition(words, pivot):
+                stack.append((node, d, group))
+
+    def graft(self, parent, arrays):
+        """Attaches a subtree returned by build_bktree_partition
+        below node parent."""
+        (words, first_child, next_sibling, edge) = arrays
+        offset = len(self.words)
+        self.words.extend(words)
+        self.first_child.extend(array.array('i',
+                [c + offset if c != -1 else -1 for c in first_child]))
+        self.next_sibling.extend(array.array('i',
+                [s + offset if s != -1 else -1 for s in next_sibling]))
+        self.edge.extend(edge)
+        self.next_sibling[offset] = self.first_child[parent]
+        self.first_child[parent] = offset
+
+    def __new_node(self, word, distance):
+        self.words.append(word)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.edge.append(distance)
+        return len(self.words) - 1
+
+    def add_word(self, word):
+        if not self.words:
+            self.__new_node(word, 0)
+            self.word_added(word)
             return
-        if distance in node.children:
-            self.__add_recursively(node.children[distance], word)
-        else:
-            new_node = BKNode(word)
-            node.children[distance] = new_node
+        node = 0
+        while True:
+            distance = self.distance.distance(word, self.words[node])
+            if distance == 0:
+                return
+            child = self.first_child[node]
+            while child != -1 and self.edge[child] != distance:
+                child = self.next_sibling[child]
+            if child == -1:
+                new_node = self.__new_node(word, distance)
+                self.next_sibling[new_node] = self.first_child[node]
+                self.first_child[node] = new_node
+                self.word_added(word)
+                return
+            node = child
+
+    def children(self, node):
+        """A list of (edge distance, child) pairs of a node."""
+        result = []
+        child = self.first_child[node]
+        while child != -1:
+            result.append((self.edge[child], child))
+            child = self.next_sibling[child]
+        return result
+
+    def __node_distance(self, query, node, children, max_error):
+        # Children are only visited when the distance is at most
+        # max_error above their edge, so larger distances need
+        # not be computed exactly.
+        limit = max_error
+        if children:
+            limit += max(children)[0]
+        return self.distance.distance(query, self.words[node], limit)
 
     def find(self, query, max_error):
-        if self.root is None:
+        if not self.words:
             return []
+        if self.cache is not None:
+            key = self.cache_key('within', query, max_error)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return list(cached)
         matches = []
-        self.__match_recursively(self.root, query, max_error, matches)
+        stack = [0]
+        (visited, seen) = (0, 0)
+        while stack:
+            node = stack.pop()
+            children = self.children(node)
+            visited += 1
+            seen += len(children)
+            distance = self.__node_distance(query, node, children, max_error)
+            if distance == OVER_LIMIT:
+                continue
+            if distance <= max_error:
+                matches.append((distance, self.words[node]))
+            for (d, child) in children:
+                if d >= distance-max_error and d <= distance+max_error:
+                    stack.append(child)
+        self.count_nodes(visited, seen)
         matches.sort()
+        if self.cache is not None:
+            self.cache.put(key, list(matches))
         return matches
 
-    def __match_recursively(self, node, query, max_error, matches):
-        distance = self.distance.distance(query, node.word)
-        if distance <= max_error:
-            matches.append((distance, node.word))
-        for d in node.children.keys():
-            if d >= distance-max_error and d <= distance+max_error:
-                self.__match_recursively(node.children[d], query, max_error, matches)
-
-class BKNode():
-    def __init__(self, word):
-        self.word = word
-        self.children = {}
+    def walk(self, query, radius):
+        """Yields (distance, word) for the nodes a search visits, where
+        radius() is the current search radius. It is called again
+        before every node, so it can shrink while the caller takes
+        the words. Nodes found to be over it are not yielded."""
+        if not self.words:
+            return
+        # Entries are (lower bound, node). Edges closest to the
+        # distance are pushed last so that they are visited first.
+        stack = [(0, 0)]
+        (visited, seen) = (0, 0)
+        while stack:
+            (bound, node) = stack.pop()
+            if bound > radius():
+                continue
+            children = self.children(node)
+            visited += 1
+            seen += len(children)
+            distance = self.__node_distance(query, node, children, radius())
+            if distance == OVER_LIMIT:
+                continue
+            yield (distance, self.words[node])
+            pending = [(abs(d - distance), child) for (d, child) in children]
+            pending.sort(reverse=True)
+            limit = radius()
+            for (child_bound, child) in pending:
+                if child_bound <= limit:
+                    stack.append((child_bound, child))
+        self.count_nodes(visited, seen)
+
+    def find_top_k(self, query, k):
+        """The k closest words as a list of (distance, word), closest
+        first and equal distances ordered by word. Only works when
+        the distance is a metric, like find."""
+        top = TopK(k)
+        if not self.words or k <= 0:
+            return []
+        if self.cache is not None:
+            key = self.cache_key('top_k', query, k)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return list(cached)
+        for (distance, word) in self.walk(query, top.bound):
+            top.offer(distance, word)
+        result = top.result()
+        if self.cache is not None:
+            self.cache.put(key, list(result))
+        return result
+
+
+def build_bktree_partition(distance_function, distance, words, sample_size):
+    """Builds one subtree of a BKTree in a worker process. Returns the
+    node arrays, with the subtree root first."""
+    bktree = BKTree(distance_function)
+    bktree.build_subtree(-1, distance, words, sample_size)
+    return (bktree.words, bktree.first_child, bktree.next_sibling, bktree.edge)
+
+
+class CandidateIndexMatcher(BasicWordMatcher):
+    """Base of the matchers with an index that gives candidate words
+for a number of edits, so that only the candidates are checked with
+the evaluator. Subclasses give candidates(word, edits), edit_penalty()
+and edit_limit(word). Queries the index can not bound are answered
+by scanning."""
+
+    instrumented_methods = BasicWordMatcher.instrumented_methods + ('candidates',)
+
+    def candidates(self, word, edits):
+        """The words at most edits edits from word, and maybe others."""
+        raise NotImplementedError
+
+    def edit_penalty(self):
+        """No edit, as the index counts them, costs less than this."""
+        raise NotImplementedError
+
+    def edit_limit(self, word):
+        """(edits, complete): the most edits candidates can be asked
+        for, and whether every word is a candidate at that many."""
+        raise NotImplementedError
+
+    def edit_count(self, word, max_error):
+        """The edits whose candidates hold every word within max_error
+        of word, or None if the index can not give them."""
+        cost = self.edit_penalty()
+        if cost <= 0:
+            return None
+        edits = int(max_error // cost)
+        (limit, complete) = self.edit_limit(word)
+        if edits > limit:
+            return limit if complete else None
+        return edits
+
+    def find_within(self, word, max_error):
+        self.check_string(word)
+        word = self.normalize_query(word)
+        edits = self.edit_count(word, max_error)
+        if edits is None:
+            return super(CandidateIndexMatcher, self).find_within(word, max_error)
+        cached = self.cache_get('within', word, max_error)
+        if cached is not None:
+            return cached
+        if max_error < self.fold_bound():
+            return self.fold_within(word, max_error)
+        within = []
+        candidates = self.candidates(word, edits)
+        for w in candidates:
+            dist = self.dev.distance(word, w, max_error)
+            if dist <= max_error:
+                within.append((dist, w))
+        self.count(len(candidates), len(candidates))
+        return self.cache_put('within', word, max_error, sort_by_distance(within))
+
+    def find_closest(self, word):
+        """Checks the candidates of 0, 1, 2, 4... edits until no word
+        outside them can beat or tie the best one found."""
+        self.check_string(word)
+        word = self.normalize_query(word)
+        cost = self.edit_penalty()
+        if cost <= 0 or len(self.words) == 0:
+            return super(CandidateIndexMatcher, self).find_closest(word)
+        closest = self.closest_shortcut(word)
+        if closest is not None:
+            return closest
+        (limit, complete) = self.edit_limit(word)
+        checked = set()
+        best = (OVER_LIMIT, '')
+        edits = 0
+        while True:
+            candidates = self.candidates(word, edits)
+            for w in candidates:
+                if w not in checked:
+                    checked.add(w)
+                    dist = self.dev.distance(word, w, best[0])
+                    if (dist, w) < best:
+                        best = (dist, w)
+            self.count(len(candidates), 0)
+            # A word that is not a candidate for n edits
+            # is at least (n+1)*cost away.
+            if best[0] < (edits + 1)*cost or (edits >= limit and complete):
+                self.count(0, len(checked))
+                return self.cache_put('closest', word, None, best)
+            if edits >= limit:
+                break
+            edits = min(max(1, 2*edits), limit)
+        self.count(0, len(checked))
+        return super(CandidateIndexMatcher, self).find_closest(word)
+
+
+class TwoStageWordMatcher(CandidateIndexMatcher):
+    """A matcher for penalties that are not a metric, so they can not
+be used in a BK tree directly. The folded forms of the words (see
+fold) are also kept in a BK tree over plain Levenshtein distance.
+Swaps that fold away are free there, and every other edit costs at
+least fold_bound(), so a word within max_error is at most
+max_error/fold_bound() edits from the query once both are folded.
+Only the words whose folded forms the tree gives for that many edits
+are checked with the real penalties.
+
+Levenshtein distance counts a transposition as two edits. When a
+transposition costs at least two other edits that changes nothing.
+When it is cheaper, the tree is searched one edit around the folded
+query and its transpositions, and budgets of more edits are answered
+by scanning, since a search of twice the radius visits most of the
+tree."""
+
+    def __init__(self, penalty=None, evaluator=None, allow_spaces=False):
+        super(TwoStageWordMatcher, self).__init__(penalty, evaluator, allow_spaces)
+        self.metric_penalties = PlainLevenshteinPenalties()
+        self.bktree = BKTree(EditDistanceEvaluator(self.metric_penalties))
+        self.tree_fingerprint = None
+        self.tree_words = 0     # words whose folded forms are in the tree
+
+    def stats_parts(self):
+        return [('evaluator', self.dev), ('bktree', self.bktree)]
+
+    def stats(self):
+        """Candidates are the words the tree returned and verified the
+        ones checked with the real penalties. Pruned is the share of
+        words the tree saved from checking."""
+        result = super(TwoStageWordMatcher, self).stats()
+        if result:
+            queries = result.get('calls.find_within', 0) + \
+                result.get('calls.find_closest', 0) + \
+                result.get('calls.find_top_k', 0)
+            total = queries*len(self.words)
+            if total > 0:
+                result['pruned'] = 1.0 - result.get('verified', 0)/total
+            else:
+                result['pruned'] = 0.0
+        return result
+
+    def folded_tree(self):
+        """The tree of folded forms, brought up to date like folding():
+        the words added since it was last used are folded into it, and
+        it is rebuilt when the groups of the penalties have changed."""
+        self.folding()
+        if self.tree_fingerprint != self.fold_fingerprint:
+            self.tree_fingerprint = self.fold_fingerprint
+            self.tree_words = 0
+            self.bktree = BKTree(EditDistanceEvaluator(self.metric_penalties))
+            if self.stats_counters is not None:
+                self.bktree.enable_stats()
+        if self.tree_words < len(self.words):
+            ids = range(self.tree_words, len(self.words))
+            for w in self.words.decode(ids):
+                self.bktree.add_word(self.fold(w))
+            self.tree_words = len(self.words)
+        return self.bktree
+
+    def cheap_transpositions(self):
+        """Whether a transposition costs less than two edits."""
+        table = self.dev.get_compiled()
+        return table.transpose_penalty < 2*self.fold_bound()
+
+    def edit_penalty(self):
+        return self.fold_bound()
+
+    def edit_limit(self, word):
+        if self.cheap_transpositions():
+            return (1, False)
+        # Every word is within its length plus that of word.
+        return (max(list(self.by_length) + [0]) + len(word), True)
+
+    def candidates(self, word, edits):
+        """The words whose folded forms are at most edits edits, with a
+        transposition as one, from that of word."""
+        tree = self.folded_tree()
+        unit = self.metric_penalties.get_swap_penalty()
+        keys = set()
+        variants = set([self.fold(word)])
+        for transposed in range(edits+1):
+            if transposed == edits:
+                keys.update(variants)
+                break
+            for v in variants:
+                keys.update([k for (d, k) in tree.find(v, (edits - transposed)*unit)])
+            if not self.cheap_transpositions():
+                break
+            variants = set([v[:i] + v[i+1] + v[i] + v[i+2:] for v in variants
+                            for i in range(len(v) - 1) if v[i] != v[i+1]])
+        result = []
+        for key in keys:
+            result.extend(self.folded_words(key))
+        return result
+
+    def find_top_k(self, word, k):
+        """Walks the tree once, with a radius of the k-th best distance
+        found so far turned into edits."""
+        self.check_string(word)
+        word = self.normalize_query(word)
+        ratio = self.edit_penalty()
+        if ratio <= 0 or k <= 0 or self.cheap_transpositions():
+            return super(TwoStageWordMatcher, self).find_top_k(word, k)
+        tree = self.folded_tree()
+        unit = self.metric_penalties.get_swap_penalty()
+        top = TopK(k)
+        radius = lambda : top.bound()*unit/ratio
+        (candidates, verified) = (0, 0)
+        for (metric, key) in tree.walk(self.fold(word), radius):
+            # Each edit costs at least ratio, so this is a lower bound.
+            if metric*ratio/unit > top.bound():
+                candidates += 1
+                continue
+            for w in self.folded_words(key):
+                candidates += 1
+                verified += 1
+                top.offer(self.dev.distance(word, w, top.bound()), w)
+        self.count(candidates, verified)
+        return top.result()
+
+
+class DeletionIndexMatcher(CandidateIndexMatcher):
+    """A matcher for small edit budgets. Every word is stored under all
+the strings left after deleting up to max_edits of its characters.
+Two words at most n edits apart, counting a transposition as one edit,
+have a deletion in common with at most n characters gone from each.
+So the words within max_error are found by looking up the deletions
+of the query, and only those are checked with the evaluator. Budgets
+that need more than max_edits edits are answered by scanning."""
+
+    def __init__(self, penalty=None, evaluator=None, allow_spaces=False,
+                 max_edits=2):
+        if not isinstance(max_edits, int) or max_edits < 0:
+            raise TypeError('max_edits must be a non-negative integer')
+        super(DeletionIndexMatcher, self).__init__(penalty, evaluator, allow_spaces)
+        self.max_edits = max_edits
+        self.deletions = {}  # deleted string -> array of word ids
+
+    def add_word(self, word):
+        self.check_single_word(word)
+        if word in self.words:
+            return
+        super(DeletionIndexMatcher, self).add_word(word)
+        word_id = len(self.words) - 1
+        for variant in delete_variants(word, self.max_edits):
+            if variant in self.deletions:
+                self.deletions[variant].append(word_id)
+            else:
+                self.deletions[variant] = array.array('i', [word_id])
+
+    def edit_penalty(self):
+        return self.dev.get_compiled().min_operation_penalty
+
+    def edit_limit(self, word):
+        return (self.max_edits, False)
+
+    def candidates(self, word, edits):
+        """The words sharing a deletion of at most edits characters
+        with word."""
+        found = set()
+        for variant in delete_variants(word, edits):
+            found.update(self.deletions.get(variant, ()))
+        return set(self.words.decode(found))
+
+    def memory_footprint(self):
+        return super(DeletionIndexMatcher, self).memory_footprint() + \
+            self.memory_report()['bytes']
+
+    def memory_report(self):
+        """An estimate of the memory the deletion index takes, in bytes,
+        with the number of deletions and word entries stored."""
+        keys = 0
+        lists = sys.getsizeof(self.deletions)
+        entries = 0
+        for (variant, words) in self.deletions.items():
+            keys += sys.getsizeof(variant)
+            lists += sys.getsizeof(words)
+            entries += len(words)
+        return {'words' : len(self.words), 'max_edits' : self.max_edits,
+                'deletions' : len(self.deletions), 'entries' : entries,
+                'bytes' : keys + lists}
+
+
+def delete_variants(word, max_edits):
+    """All strings made by deleting up to max_edits characters from
+    word, including word itself."""
+    variants = set([word])
+    current = [word]
+    for _ in range(max_edits):
+        following = []
+        for w in current:
+            for i in range(len(w)):
+                variant = w[:i] + w[i+1:]
+                if variant not in variants:
+                    variants.add(variant)
+                    following.append(variant)
+        current = following
+    return variants
+
+
+class QGramIndexMatcher(CandidateIndexMatcher):
+    """A matcher with an inverted index of the q-grams of its words,
+meant for long entries such as phrases. Words are padded with q-1
+marks on both sides, so a word of length n has n+q-1 grams. Two
+strings k Levenshtein edits apart share at least max(n, m)+q-1-k*q
+grams at positions no more than k apart. The index counts the shared
+grams and only words that pass are checked with the evaluator. The
+edits for a max_error come from min_edit_penalty, which counts a
+transposition as two edits."""
+
+    PAD = '\0'
+
+    def __init__(self, penalty=None, evaluator=None, allow_spaces=False, q=2):
+        if not isinstance(q, int) or q < 1:
+            raise TypeError('q must be a positive integer')
+        super(QGramIndexMatcher, self).__init__(penalty, evaluator, allow_spaces)
+        self.q = q
+        self.lengths = array.array('i')  # word id -> length
+        # gram -> word id and position pairs, one after the other
+        self.postings = {}
+
+    def memory_footprint(self):
+        return super(QGramIndexMatcher, self).memory_footprint() + \
+            shallow_size(self.postings) + sys.getsizeof(self.lengths)
+
+    def grams(self, word):
+        """The padded grams of word with their positions."""
+        padding = self.PAD*(self.q - 1)
+        padded = padding + word + padding
+        return [(padded[i:i+self.q], i) for i in range(len(word) + self.q - 1)]
+
+    def add_word(self, word):
+        self.check_single_word(word)
+        if word in self.words:
+            return
+        super(QGramIndexMatcher, self).add_word(word)
+        word_id = len(self.words) - 1
+        self.lengths.append(len(word))
+        for (gram, position) in self.grams(word):
+            if gram not in self.postings:
+                self.postings[gram] = array.array('i')
+            self.postings[gram].extend((word_id, position))
+
+    def edit_penalty(self):
+        return self.dev.get_compiled().min_edit_penalty
+
+    def edit_limit(self, word):
+        # Every word is a candidate once the edits cover the longer one.
+        return (max(list(self.by_length) + [len(word)]), True)
+
+    def candidates(self, word, edits):
+        """The words that pass the length and count filters for
+        edits Levenshtein edits from word."""
+        length = len(word)
+        found = set()
+        # Short words can pass without sharing any gram.
+        for (other, ids) in self.by_length.items():
+            if abs(other - length) <= edits and \
+                    max(other, length) + self.q - 1 <= edits*self.q:
+                found.update(ids)
+        counts = {}
+        lengths = self.lengths
+        for (gram, position) in self.grams(word):
+            postings = self.postings.get(gram)
+            if postings is None:
+                continue
+            for i in range(0, len(postings), 2):
+                word_id = postings[i]
+                if abs(postings[i+1] - position) <= edits and \
+                        abs(lengths[word_id] - length) <= edits:
+                    counts[word_id] = counts.get(word_id, 0) + 1
+        for (word_id, count) in counts.items():
+            needed = max(lengths[word_id], length) + self.q - 1 - edits*self.q
+            if count >= needed:
+                found.add(word_id)
+        return set(self.words.decode(found))
+
+
+def ascii_letters(word):
+    """The letters of word in upper case with accents removed.
+    Everything else is dropped."""
+    decomposed = unicodedata.normalize('NFD', word.upper())
+    return ''.join([c for c in decomposed if 'A' <= c <= 'Z'])
+
+SOUNDEX_CODES = {}
+for (letters, code) in [('BFPV', '1'), ('CGJKQSXZ', '2'), ('DT', '3'),
+                        ('L', '4'), ('MN', '5'), ('R', '6')]:
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+def soundex(word):
+    """American Soundex: the first letter and three digits for the
+    consonant sounds that follow, so 'kirgistan' and 'kyrgyzstan' are
+    both K622. Words without letters give ''."""
+    letters = ascii_letters(word)
+    if not letters:
+        return ''
+    key = letters[0]
+    last = SOUNDEX_CODES.get(letters[0], '')
+    for c in letters[1:]:
+        code = SOUNDEX_CODES.get(c, '')
+        if code and code != last:
+            key += code
+            if len(key) == 4:
+                break
+        # H and W do not separate letters with the same code,
+        # vowels do.
+        if c not in 'HW':
+            last = code
+    return (key + '000')[:4]
+
+# Applied in order; X stands for the sh sound once X itself is gone.
+METAPHONE_RULES = [('X', 'KS'), ('PH', 'F'), ('CK', 'K'), ('SCH', 'SK'),
+                   ('SH', 'X'), ('CH', 'X'), ('TH', '0'), ('DG', 'J'),
+                   ('GH', 'H'), ('CI', 'SI'), ('CE', 'SE'), ('CY', 'SY'),
+                   ('C', 'K'), ('Q', 'K'), ('Z', 'S'), ('V', 'F'),
+                   ('W', ''), ('Y', '')]
+
+def metaphone_key(word):
+    """A simplified Metaphone: common spellings of the same sound are
+    rewritten to one letter, vowels and H after the first letter are
+    dropped and repeated letters are merged. Not the full rule set,
+    but 'kirgistan' and 'kyrgyzstan' both give KRGSTN."""
+    letters = ascii_letters(word)
+    if not letters:
+        return ''
+    for (spelling, sound) in METAPHONE_RULES:
+        letters = letters.replace(spelling, sound)
+    if not letters:
+        return ''
+    key = letters[0]
+    for c in letters[1:]:
+        if c in 'AEIOUH' or key[-1] == c:
+            continue
+        key += c
+    return key
+
+
+class PhoneticWordMatcher(BasicWordMatcher):
+    """Also files words under phonetic keys, so sound-alike words are
+found with a few lookups. encoders is a list of functions from a
+word to a key; words with the same key under any of them are
+candidates, and an empty key matches nothing. The default is
+soundex."""
+
+    instrumented_methods = BasicWordMatcher.instrumented_methods + \
+        ('phonetic_candidates', 'find_sound_alike')
+
+    def __init__(self, penalty=None, evaluator=None, allow_spaces=False,
+                 encoders=None, min_candidates=1):
+        super(PhoneticWordMatcher, self).__init__(penalty, evaluator, allow_spaces)
+        if encoders is None:
+            encoders = [soundex]
+        self.encoders = list(encoders)
+        self.min_candidates = min_candidates
+        self.keys = [{} for _ in self.encoders]  # key -> array of word ids
+
+    def add_word(self, word):
+        self.check_single_word(word)
+        if word in self.words:
+            return
+        super(PhoneticWordMatcher, self).add_word(word)
+        word_id = len(self.words) - 1
+        for (encoder, keys) in zip(self.encoders, self.keys):
+            key = encoder(word)
+            if not key:
+                continue
+            if key in keys:
+                keys[key].append(word_id)
+            else:
+                keys[key] = array.array('i', [word_id])
+
+    def phonetic_candidates(self, word):
+        """The words that share a key with word under some encoder."""
+        found = set()
+        for (encoder, keys) in zip(self.encoders, self.keys):
+            key = encoder(word)
+            if key:
+                found.update(keys.get(key, ()))
+        return set(self.words.decode(found))
+
+    def find_sound_alike(self, word, limit=10):
+        """Up to limit words that sound like word, as (distance, word)
+        ranked with the evaluator. When fewer than min_candidates
+        words sound alike, this is find_top_k(word, limit)."""
+        self.check_string(word)
+        word = self.normalize_query(word)
+        candidates = self.phonetic_candidates(word)
+        if len(candidates) < self.min_candidates:
+            return self.find_top_k(word, limit)
+        top = TopK(limit)
+        for w in candidates:
+            top.offer(self.dev.distance(word, w, top.bound()), w)
+        self.count(len(candidates), len(candidates))
+        return top.result()
+
+    def memory_footprint(self):
+        size = super(PhoneticWordMatcher, self).memory_footprint()
+        for keys in self.keys:
+            size += shallow_size(keys)
+        return size
+
+
+class ShardedWordMatcher(Instrumented):
+    """Spreads the words over shards, each held by its own worker
+process with a BasicWordMatcher of its own. The penalties and the
+words of a shard are sent to the worker once, when the workers are
+started by the first query. Queries go to every shard and the
+results are merged. For closest and top-k searches the shards share
+the best bound found so far, so each shard stops as soon as another
+one has found words it can not beat. Call close() to stop the
+workers. Its stats only cover this process."""
+
+    instrumented_methods = ('find_within', 'find_closest', 'find_top_k', 'scatter')
+
+    def __init__(self, penalty=None, allow_spaces=False, shards=None):
+        if penalty is None:
+            self.penalties = BasicPenalties()
+        else:
+            self.penalties = penalty
+        if shards is None:
+            shards = os.cpu_count() or 1
+        if not isinstance(shards, int) or shards < 1:
+            raise TypeError('shards must be a positive integer')
+        self.dev = EditDistanceEvaluator(self.penalties)
+        self.allow_spaces = allow_spaces
+        self.pending = [[] for _ in range(shards)]  # words before start
+        self.connections = []
+        self.processes = []
+        self.bound = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def check_string(self, word):
+        if type(word) != type('s'):
+            raise TypeError('Argument is not a string.')
+
+    def check_single_word(self, word):
+        self.check_string(word)
+        if not self.allow_spaces and ' ' in word:
+            raise TypeError('Argument is not a single word.')
+
+    def shard_count(self):
+        return len(self.pending)
+
+    def add_word(self, word):
+        self.check_single_word(word)
+        # The same word always goes to the same shard, where
+        # the matcher drops duplicates.
+        shard = hash(word) % self.shard_count()
+        if self.processes:
+            self.connections[shard].send(('add', word))
+        else:
+            self.pending[shard].append(word)
+
+    def start(self):
+        """Starts the workers, if they are not running yet."""
+        if self.processes:
+            return
+        self.bound = multiprocessing.Value('d', OVER_LIMIT)
+        for shard in range(self.shard_count()):
+            (here, there) = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=shard_worker, daemon=True,
+                args=(there, self.penalties, self.allow_spaces,
+                      self.pending[shard], self.bound))
+            process.start()
+            there.close()
+            self.connections.append(here)
+            self.processes.append(process)
+            self.pending[shard] = []
+
+    def close(self):
+        """Stops the workers. Their words are lost."""
+        for connection in self.connections:
+            connection.send(('close',))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def scatter(self, *request):
+        """Sends a request to every shard and returns their answers."""
+        self.start()
+        for connection in self.connections:
+            connection.send(request)
+        answers = [connection.recv() for connection in self.connections]
+        for answer in answers:
+            if isinstance(answer, Exception):
+                raise answer
+        return answers
+
+    def size(self):
+        if not self.processes:
+            return len(set(w for shard in self.pending for w in shard))
+        return sum(self.scatter('size'))
+
+    def find_within(self, word, max_error):
+        self.check_string(word)
+        matches = []
+        for answer in self.scatter('within', word, max_error):
+            matches.extend(answer)
+        return sort_by_distance(matches)
+
+    def find_top_k(self, word, k):
+        self.check_string(word)
+        if k <= 0:
+            return []
+        self.start()
+        self.bound.value = OVER_LIMIT
+        top = TopK(k)
+        for answer in self.scatter('top_k', word, k):
+            for (dist, w) in answer:
+                top.offer(dist, w)
+        return top.result()
+
+    def find_closest(self, word):
+        top = self.find_top_k(word, 1)
+        if not top:
+            return ('', self.dev.distance(word, ''))
+        return top[0]
+
+    def distinct_blocks(self, queries, block_size):
+        distinct = []
+        seen = set()
+        for q in queries:
+            self.check_string(q)
+            if q not in seen:
+                seen.add(q)
+                distinct.append(q)
+        return [distinct[i:i+block_size]
+                for i in range(0, len(distinct), block_size)]
+
+    def find_within_many(self, queries, max_error, block_size=256):
+        """Yields (query, matches) for every distinct query. Each
+        block of queries is sent to the workers in one request."""
+        for block in self.distinct_blocks(queries, block_size):
+            within = dict([(q, []) for q in block])
+            for answer in self.scatter('within_many', block, max_error):
+                for (q, matches) in answer:
+                    within[q].extend(matches)
+            for q in block:
+                yield (q, sort_by_distance(within[q]))
+
+    def find_closest_many(self, queries, block_size=256):
+        """Yields (query, (distance, word)) for every distinct query,
+        in blocks like find_within_many."""
+        for block in self.distinct_blocks(queries, block_size):
+            closest = {}
+            for answer in self.scatter('closest_many', block):
+                for (q, best) in answer:
+                    if q not in closest or best[0] < closest[q][0]:
+                        closest[q] = best
+            for q in block:
+                if q in closest:
+                    yield (q, closest[q])
+                else:
+                    yield (q, ('', self.dev.distance(q, '')))
+
+
+def shard_worker(connection, penalties, allow_spaces, words, bound):
+    """Serves the requests of a ShardedWordMatcher for one shard. Adds
+    are not answered, so an add that fails is answered at the next
+    query instead."""
+    matcher = BasicWordMatcher(penalties, None, allow_spaces)
+    for w in words:
+        matcher.add_word(w)
+    del words
+    failure = None
+    while True:
+        request = connection.recv()
+        if request[0] == 'close':
+            break
+        elif request[0] == 'add':
+            try:
+                matcher.add_word(request[1])
+            except Exception as e:
+                if failure is None:
+                    failure = e
+            continue
+        elif failure is not None:
+            connection.send(failure)
+            failure = None
+            continue
+        try:
+            if request[0] == 'size':
+                answer = matcher.size()
+            elif request[0] == 'within':
+                answer = matcher.find_within(request[1], request[2])
+            elif request[0] == 'top_k':
+                answer = shard_top_k(matcher, request[1], request[2], bound)
+            elif request[0] == 'within_many':
+                answer = list(matcher.find_within_many(request[1], request[2]))
+            elif request[0] == 'closest_many':
+                # An empty shard has nothing to offer.
+                answer = []
+                if matcher.size() > 0:
+                    answer = list(matcher.find_closest_many(request[1]))
+            else:
+                raise ValueError('Unknown shard request %r.' % (request[0],))
+        except Exception as e:
+            answer = e
+        connection.send(answer)
+    connection.close()
+
+
+def shard_top_k(matcher, word, k, bound):
+    """The top k of one shard. Words further away than the k-th best
+    distance of any shard can not be in the merged result. Words at
+    that distance still can, so the shared bound is inclusive."""
+    word = matcher.normalize_query(word)
+    top = TopK(k)
+    for (lower, length, bucket) in matcher.length_buckets(word):
+        if lower > min(top.bound(), bound.value):
+            break
+        for w in matcher.bucket_order(word, bucket):
+            limit = min(top.bound(), bound.value)
+            dist = matcher.dev.distance(word, w, limit)
+            if dist > limit:
+                continue
+            top.offer(dist, w)
+            if top.bound() < bound.value:
+                with bound.get_lock():
+                    if top.bound() < bound.value:
+                        bound.value = top.bound()
+    return top.result()
+
+
+# Index files start with a fixed header followed by sections: the
+# penalty fingerprint as JSON, the buffer, offsets and hash table of a
+# StringPool of the words and, for word matchers, the word lengths
+# with the number of words of each and their ids by length or, for BK
+# trees, the node arrays. The header gives where each section starts
+# and how long it is. Arrays
+# are stored in the byte order of the machine that wrote them, and
+# every section starts at a multiple of 8 bytes so it can be used in
+# place through mmap.
+
+INDEX_MAGIC = b'FWIMIDX\0'
+INDEX_VERSION = 1
+INDEX_WORDS = 1
+INDEX_BKTREE = 2
+INDEX_SECTIONS = ('fingerprint', 'pool', 'offsets', 'table', 'lengths',
+                  'length_ids', 'first_child', 'next_sibling', 'edge')
+INDEX_HEADER = struct.Struct('<8sIIIIQ%dQ' % (2*len(INDEX_SECTIONS)))
+
+def write_index(filename, kind, pool, penalties, buckets=None, nodes=None):
+    """Writes a StringPool of words and either the buckets of a word
+    matcher (length -> array of ids) or the node arrays of a BK tree
+    (first_child, next_sibling, edge) to an index file."""
+    sections = {
+        'fingerprint' : json.dumps(penalties.fingerprint()).encode('utf-8'),
+        'pool' : bytes(pool.data),
+        'offsets' : bytes(pool.offsets),
+        'table' : bytes(pool.table),
+    }
+    if buckets is not None:
+        lengths = array.array('q')
+        for (length, ids) in sorted(buckets.items()):
+            lengths.extend([length, len(ids)])
+        sections['lengths'] = lengths.tobytes()
+        sections['length_ids'] = b''.join([bytes(buckets[length])
+                                           for length in sorted(buckets)])
+    if nodes is not None:
+        (first_child, next_sibling, edge) = nodes
+        sections['first_child'] = array.array('i', first_child).tobytes()
+        sections['next_sibling'] = array.array('i', next_sibling).tobytes()
+        sections['edge'] = array.array('d', edge).tobytes()
+    places = []
+    position = INDEX_HEADER.size
+    for name in INDEX_SECTIONS:
+        section = sections.get(name, b'')
+        position += -position % 8
+        places.extend([position, len(section)])
+        position += len(section)
+    little_endian = 1 if sys.byteorder == 'little' else 0
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, kind, little_endian,
+                               0, len(pool), *places)
+    ofile = open(filename, mode='wb')
+    ofile.write(header)
+    for (k, name) in enumerate(INDEX_SECTIONS):
+        ofile.write(b'\0'*(places[2*k] - ofile.tell()))
+        ofile.write(sections.get(name, b''))
+    ofile.close()
+
+def penalty_changes(stored, current):
+    """How the fingerprint current differs from stored, both as
+    read back from JSON, in words."""
+    if stored[0] != current[0]:
+        return ['the file has %s, not %s' % (stored[0], current[0])]
+    (old, new) = (dict(stored[1]), dict(current[1]))
+    changes = []
+    for name in sorted(set(old) | set(new)):
+        if old.get(name) != new.get(name):
+            changes.append('%s is %s in the file, not %s' % (
+                name, json.dumps(old.get(name)), json.dumps(new.get(name))))
+    return changes
+
+
+class IndexFile():
+    """An index file opened with mmap. Nothing is copied out of the file
+until it is used. close() unmaps it, after which the words and arrays
+taken from it can not be used."""
+
+    def __init__(self, filename):
+        ifile = open(filename, mode='rb')
+        try:
+            self.mapping = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            ifile.close()
+        self.views = []     # every view of the mapping, for close
+        try:
+            self.read_sections()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mapping.close()
+
+    def read_sections(self):
+        if len(self.mapping) < INDEX_HEADER.size:
+            raise ValueError('Not an index file.')
+        fields = INDEX_HEADER.unpack_from(self.mapping, 0)
+        (magic, version, self.kind, little_endian, reserved,
+         self.word_count) = fields[:6]
+        places = fields[6:]
+        if magic != INDEX_MAGIC:
+            raise ValueError('Not an index file.')
+        if version != INDEX_VERSION:
+            raise ValueError('Unsupported index file version %d.' % version)
+        if little_endian != (sys.byteorder == 'little'):
+            raise ValueError('Index file has the wrong byte order.')
+        view = memoryview(self.mapping)
+        self.views.append(view)
+        sections = {}
+        for (k, name) in enumerate(INDEX_SECTIONS):
+            sections[name] = self.section(view, places[2*k], places[2*k+1])
+        count = self.word_count
+        self.fingerprint = json.loads(str(sections['fingerprint'], 'utf-8'))
+        offsets = self.cast(sections['offsets'], 'q', count + 1)
+        previous = 0
+        for offset in offsets:
+            if offset < previous:
+                raise ValueError('Index file is truncated.')
+            previous = offset
+        if offsets[-1] != len(sections['pool']):
+            raise ValueError('Index file is truncated.')
+        table = self.cast(sections['table'], 'i', len(sections['table'])//4)
+        # Lookups need a power of two slots with at least one free.
+        if len(table) <= count or len(table) & (len(table) - 1):
+            raise ValueError('Index file is truncated.')
+        self.words = MappedStringPool(sections['pool'], offsets, table)
+        if self.kind == INDEX_WORDS:
+            lengths = self.cast(sections['lengths'], 'q',
+                                len(sections['lengths'])//8)
+            ids = self.cast(sections['length_ids'], 'i', count)
+            self.by_length = {}
+            start = 0
+            for k in range(0, len(lengths) - 1, 2):
+                end = start + lengths[k+1]
+                if end > count:
+                    raise ValueError('Index file is truncated.')
+                self.by_length[lengths[k]] = self.track(ids[start:end])
+                start = end
+            if start != count:
+                raise ValueError('Index file is truncated.')
+        elif self.kind == INDEX_BKTREE:
+            self.first_child = self.cast(sections['first_child'], 'i', count)
+            self.next_sibling = self.cast(sections['next_sibling'], 'i', count)
+            self.edge = self.cast(sections['edge'], 'd', count)
+        else:
+            raise ValueError('Unknown index file kind %d.' % self.kind)
+
+    def section(self, view, start, length):
+        """length bytes of the file from start, which must be
+        within the file."""
+        if start < INDEX_HEADER.size or start + length > len(self.mapping):
+            raise ValueError('Index file is truncated.')
+        return self.track(view[start:start + length])
+
+    def track(self, view):
+        """Keeps view to be released by close."""
+        self.views.append(view)
+        return view
+
+    def cast(self, section, format, count):
+        """A section as an array of count items of format."""
+        result = self.track(section.cast(format))
+        if len(result) != count:
+            raise ValueError('Index file is truncated.')
+        return result
+
+    def check_penalties(self, penalties):
+        current = json.loads(json.dumps(penalties.fingerprint()))
+        if current != self.fingerprint:
+            raise ValueError('Index file was built with different penalties: ' +
+                             '; '.join(penalty_changes(self.fingerprint, current)) +
+                             '.')
+
+
+class MappedBKTree(BKTree):
+    """A BK tree that is searched straight from an index file
+written by BKTree.save. It can not be changed."""
+
+    def __init__(self, distance_function, index):
+        super(MappedBKTree, self).__init__(distance_function)
+        self.index = index
+        self.words = index.words
+        self.first_child = index.first_child
+        self.next_sibling = index.next_sibling
+        self.edge = index.edge
+
+    def add_word(self, word):
+        raise TypeError('A mapped BK tree is read-only.')
+
+    def bulk_build(self, words, workers=None, sample_size=8):
+        raise TypeError('A mapped BK tree is read-only.')
+
+    def memory_footprint(self):
+        # The file is paged in by the system as needed.
+        return len(self.index.mapping)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmaps the index file. The tree can not be used after this."""
+        self.index.close()
+
+
+def load_bktree(filename, distance_function):
+    """Opens a BK tree saved with BKTree.save. The penalties of
+    distance_function must be the ones the tree was built with."""
+    index = IndexFile(filename)
+    try:
+        if index.kind != INDEX_BKTREE:
+            raise ValueError('Index file does not hold a BK tree.')
+        index.check_penalties(distance_function.penalties)
+    except Exception:
+        index.close()
+        raise
+    return MappedBKTree(distance_function, index)
+
+class MappedWordMatcher(BasicWordMatcher):
+    """A BasicWordMatcher that is searched straight from an index file
+written by a word matcher's save: the words and the buckets of word
+lengths are views of the file. It can not be changed."""
+
+    def __init__(self, penalty, index, evaluator=None):
+        super(MappedWordMatcher, self).__init__(penalty, evaluator)
+        self.index = index
+        self.words = index.words
+        self.by_length = index.by_length
+
+    def add_word(self, word):
+        raise TypeError('A mapped word matcher is read-only.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmaps the index file. The matcher can not be used after this."""
+        self.index.close()
+
+
+def load_word_matcher(filename, penalty=None, evaluator=None):
+    """Opens an index file saved with a word matcher's save as a
+    read-only MappedWordMatcher. The penalties, BasicPenalties if not
+    given, must be the ones the words were saved with."""
+    if penalty is None:
+        penalty = BasicPenalties()
+    index = IndexFile(filename)
+    try:
+        if index.kind != INDEX_WORDS:
+            raise ValueError('Index file does not hold words.')
+        index.check_penalties(penalty)
+    except Exception:
+        index.close()
+        raise
+    return MappedWordMatcher(penalty, index, evaluator)
 
+def load_words(filename, matcher):
+    """Adds the words of an index file saved with a word matcher's
+    save to matcher, which must use the same penalties. This copies
+    every word; load_word_matcher serves them from the file."""
+    with IndexFile(filename) as index:
+        index.check_penalties(matcher.get_penalties())
+        for w in index.words:
+            matcher.add_word(w)
+    return matcher
@@ -0,0 +1,251 @@
+#!/usr/bin/python3 -tt
+# -*- coding: UTF-8 -*-
+
+#    Benchmarks for the matchers and evaluators
+#    Copyright (C) 2011 Rick Dangerous
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times word list building and queries on fixed workloads and prints
+the results as JSON, so that runs of different versions can be
+compared. Workloads are the bundled country list, /usr/share/dict/words
+if it exists and generated word lists of the given sizes. Everything
+random comes from --seed, so the same arguments give the same words
+and queries.
+
+Example: ./fwim_bench.py --sizes 10000,1000000 --output before.json"""
+
+from fwim import *
+
+import argparse, json, os, platform, random, sys, time, tracemalloc
+
+DICT_WORDS = '/usr/share/dict/words'
+COUNTRIES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'list of countries.txt')
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+ACCENTED = 'áéíóúäëïöüñ'
+TARGETS = ['evaluator', 'basic', 'caseinsensitive', 'bktree']
+
+def read_words(filename):
+    words = []
+    with open(filename, encoding='utf-8', errors='replace') as ifile:
+        for line in ifile:
+            w = line.strip()
+            if w:
+                words.append(w)
+    return words
+
+def synthetic_words(count, seed):
+    """count distinct words of 3 to 12 letters. Lengths are weighted
+    towards 6 to 8 like a natural language and one word in twenty has
+    an accented letter."""
+    rnd = random.Random(seed)
+    lengths = list(range(3, 13))
+    weights = [2, 5, 8, 10, 10, 9, 7, 5, 3, 2]
+    words = set()
+    while len(words) < count:
+        length = rnd.choices(lengths, weights)[0]
+        w = ''.join([rnd.choice(LETTERS) for _ in range(length)])
+        if rnd.random() < 0.05:
+            i = rnd.randrange(length)
+            w = w[:i] + rnd.choice(ACCENTED) + w[i+1:]
+        words.add(w)
+    return sorted(words)
+
+def workloads(names, sizes, seed):
+    """Yields (name, words) for the workloads asked for."""
+    for name in names:
+        if name == 'countries':
+            yield ('countries', read_words(COUNTRIES))
+        elif name == 'dict':
+            if os.path.exists(DICT_WORDS):
+                yield ('dict', read_words(DICT_WORDS))
+            else:
+                print('Skipping dict, ' + DICT_WORDS + ' not found.',
+                      file=sys.stderr)
+        elif name == 'synthetic':
+            for size in sizes:
+                yield ('synthetic-' + str(size), synthetic_words(size, seed))
+        else:
+            raise ValueError('Unknown workload ' + name)
+
+def misspell(word, rnd):
+    """word with one random edit, like a typing mistake."""
+    if not word:
+        return rnd.choice(LETTERS)
+    i = rnd.randrange(len(word))
+    edit = rnd.randrange(4)
+    if edit == 0:
+        return word[:i] + word[i+1:]
+    if edit == 1:
+        return word[:i] + rnd.choice(LETTERS) + word[i:]
+    if edit == 2 and i+1 < len(word):
+        return word[:i] + word[i+1] + word[i] + word[i+2:]
+    return word[:i] + rnd.choice(LETTERS) + word[i+1:]
+
+def make_queries(words, count, seed):
+    rnd = random.Random(seed + 1)
+    return [misspell(rnd.choice(words), rnd) for _ in range(count)]
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-p*len(sorted_values)//100)))
+    return sorted_values[rank-1]
+
+def time_queries(query, queries, max_seconds):
+    """Runs query on every query until the time runs out. Returns the
+    latencies in seconds."""
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    for q in queries:
+        start = time.perf_counter()
+        query(q)
+        end = time.perf_counter()
+        latencies.append(end - start)
+        if end > deadline:
+            break
+    return latencies
+
+def builders(words):
+    """Per target, a function that builds it from words and the
+    queries to time on it."""
+    single = [w for w in words if ' ' not in w]
+    def evaluator():
+        return EditDistanceEvaluator(BasicPenalties())
+    def basic():
+        matcher = BasicWordMatcher(None, None, True)
+        for w in words:
+            matcher.add_word(w)
+        return matcher
+    def caseinsensitive():
+        matcher = CaseInsensitiveWordMatcher()
+        for w in single:
+            matcher.add_word(w)
+        return matcher
+    def bktree():
+        tree = BKTree(EditDistanceEvaluator(PlainLevenshteinPenalties()))
+        tree.bulk_build(words, 1)
+        return tree
+    return {'evaluator' : evaluator, 'basic' : basic,
+            'caseinsensitive' : caseinsensitive, 'bktree' : bktree}
+
+def operations(target, built, words, queries, max_error, seed):
+    """(name, function of one input, inputs) to time on a built target.
+    The evaluator is timed on (query, target) pairs drawn up front, so
+    that the choosing is not timed and both operations see the same
+    pairs."""
+    if target == 'evaluator':
+        rnd = random.Random(seed + 2)
+        pairs = [(q, rnd.choice(words)) for q in queries]
+        return [('distance', lambda p : built.distance(p[0], p[1]), pairs),
+                ('bounded_distance',
+                 lambda p : built.distance(p[0], p[1], max_error), pairs)]
+    if target == 'bktree':
+        return [('find', lambda q : built.find(q, max_error), queries),
+                ('find_top_k', lambda q : built.find_top_k(q, 10), queries)]
+    return [('find_within', lambda q : built.find_within(q, max_error), queries),
+            ('find_closest', built.find_closest, queries)]
+
+def peak_memory(build):
+    """Peak bytes allocated while building, as seen by tracemalloc."""
+    tracemalloc.start()
+    try:
+        built = build()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del built
+    return peak
+
+def run(args):
+    results = []
+    for (name, words) in workloads(args.workloads, args.sizes, args.seed):
+        queries = make_queries(words, args.queries, args.seed)
+        builds = builders(words)
+        for target in args.targets:
+            start = time.perf_counter()
+            built = builds[target]()
+            build_seconds = time.perf_counter() - start
+            memory = None
+            if args.memory:
+                memory = peak_memory(builds[target])
+            for (operation, query, inputs) in operations(target, built, words,
+                                                         queries, args.max_error,
+                                                         args.seed):
+                latencies = time_queries(query, inputs, args.max_seconds)
+                total = sum(latencies)
+                latencies.sort()
+                results.append({
+                    'workload' : name,
+                    'words' : len(words),
+                    'target' : target,
+                    'operation' : operation,
+                    'build_seconds' : build_seconds,
+                    'peak_build_memory_bytes' : memory,
+                    'queries' : len(latencies),
+                    'p50_ms' : percentile(latencies, 50)*1000,
+                    'p95_ms' : percentile(latencies, 95)*1000,
+                    'p99_ms' : percentile(latencies, 99)*1000,
+                    'qps' : len(latencies)/total if total > 0 else None,
+                })
+                print(name, target, operation, 'done', file=sys.stderr)
+    return {
+        'label' : args.label,
+        'python' : platform.python_version(),
+        'implementation' : platform.python_implementation(),
+        'machine' : platform.machine(),
+        'seed' : args.seed,
+        'max_error' : args.max_error,
+        'results' : results,
+    }
+
+def comma_list(text):
+    return [item for item in text.split(',') if item]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workloads', type=comma_list,
+                        default=['countries', 'dict', 'synthetic'],
+                        help='any of countries, dict and synthetic')
+    parser.add_argument('--sizes', type=lambda text : [int(s) for s in comma_list(text)],
+                        default=[10000],
+                        help='sizes of the synthetic word lists, 10000 to 5000000')
+    parser.add_argument('--targets', type=comma_list, default=TARGETS,
+                        help='any of ' + ', '.join(TARGETS))
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--max-error', type=int, default=20)
+    parser.add_argument('--max-seconds', type=float, default=30.0,
+                        help='stop timing an operation after this long')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='',
+                        help='stored in the output, e.g. a version')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the extra build that measures memory')
+    parser.add_argument('--output', help='file for the JSON, default stdout')
+    args = parser.parse_args(argv)
+    for target in args.targets:
+        if target not in TARGETS:
+            parser.error('unknown target ' + target)
+    return args
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            ofile.write(report + '\n')
+    else:
+        print(report)
@@ -29,10 +29,13 @@ matches = []
 penalties = LessEndPenalties()
 evaluator = EditDistanceEvaluator(penalties)
 matcher = BasicWordMatcher(penalties, evaluator, True)
+session = None
 
 def load_data(dfile):
+    global session
     for line in open(dfile):
         matcher.add_word(line.strip().lower())
+    session = matcher.session(100)
 
 def init_graphics():
     global stdscr
@@ -70,10 +73,11 @@ def process_input():
 
 def match():
     global query, matches
+    session.set_query(query)
     if query == '':
         m = []
     else:
-        m = matcher.find_within(query, 100)[:10]
+        m = session.results()[:10]
     matches = m
     
 
@@ -17,9 +17,36 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array, contextlib, io, multiprocessing, os, pickle, sys, tempfile
+import threading
 import unittest
 import fwim
 
+COUNTRIES = ['germany', 'georgia', 'greece', 'guinea', 'guinea-bissau',
+             'gabon', 'gambia', 'ger', 'g', '', 'gérmany', 'grèece']
+QUERIES = ['ger', 'gremany', 'guinea', 'gambai', '', 'xyz', 'germäny']
+
+class SameResults():
+    """Checks that a matcher answers like a BasicWordMatcher
+    with the same penalties and words."""
+
+    def check_same(self, matcher, penalties, words=COUNTRIES, queries=QUERIES,
+                   top_k=None):
+        plain = fwim.BasicWordMatcher(penalties, None, True)
+        for w in words:
+            matcher.add_word(w)
+            plain.add_word(w)
+        self.assertEqual(matcher.size(), plain.size())
+        for query in queries:
+            for max_error in [0, 5, 10, 20, 35]:
+                self.assertEqual(sorted(matcher.find_within(query, max_error)),
+                                 sorted(plain.find_within(query, max_error)))
+            self.assertEqual(matcher.find_closest(query)[0],
+                             plain.find_closest(query)[0])
+            if top_k is not None:
+                self.assertEqual(matcher.find_top_k(query, top_k),
+                                 plain.find_top_k(query, top_k))
+
 class TestBasicPenalties(unittest.TestCase):
     
     def setUp(self):
@@ -260,6 +287,139 @@ class TestDistanceEvaluator(unittest.TestCase):
                          self.penalties.get_transpose_penalty() +
                          self.penalties.get_end_add_penalty())
 
+class TestBoundedDistance(unittest.TestCase):
+
+    def setUp(self):
+        self.penalties = fwim.DistinctPenalties()
+        self.dev = fwim.EditDistanceEvaluator(self.penalties)
+
+    def test_within_limit(self):
+        pairs = [('abcdefg', 'acbdeg'), ('ca', 'abc'), ('hello', 'yellow'),
+                 ('abc', ''), ('', 'abc'), ('abc', 'abc')]
+        for (source, target) in pairs:
+            exact = self.dev.distance(source, target)
+            self.assertEqual(self.dev.distance(source, target, exact), exact)
+            self.assertEqual(self.dev.distance(source, target, exact + 100),
+                             exact)
+
+    def test_over_limit(self):
+        pairs = [('abcdefg', 'acbdeg'), ('ca', 'abc'), ('hello', 'yellow'),
+                 ('abc', ''), ('', 'abc'), ('a', 'abcdefghijk')]
+        for (source, target) in pairs:
+            exact = self.dev.distance(source, target)
+            self.assertEqual(self.dev.distance(source, target, exact - 1),
+                             fwim.OVER_LIMIT)
+            self.assertEqual(self.dev.distance(source, target, 0),
+                             fwim.OVER_LIMIT)
+
+    def test_band(self):
+        compiled = self.dev.get_compiled()
+        self.assertEqual(compiled.band(5, 5, 0), (0, 0))
+        add_p = self.penalties.get_add_penalty()
+        self.assertIsNone(compiled.band(5, 7, 2*add_p - 1))
+        self.assertEqual(compiled.band(5, 7, 2*add_p), (-2, 0))
+        self.assertEqual(compiled.length_bound(3, 5),
+                         2*self.penalties.get_add_penalty())
+        self.assertEqual(compiled.length_bound(5, 3),
+                         2*self.penalties.get_drop_penalty())
+
+    def test_end_add_bound(self):
+        dev = fwim.EditDistanceEvaluator(fwim.LessEndPenalties())
+        self.assertEqual(dev.distance('ger', 'germany', 8), 8)
+        self.assertEqual(dev.distance('ger', 'germany', 7), fwim.OVER_LIMIT)
+
+@unittest.skipIf(fwim.numpy is None, 'NumPy is not installed.')
+class TestBatchEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        self.penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(self.penalties, 3)
+        self.penalties.end_add_penalty = 4
+        self.dev = fwim.EditDistanceEvaluator(self.penalties)
+        self.batch = fwim.BatchEditDistanceEvaluator(self.penalties, block_size=3)
+        self.words = ['', 'a', 'hello', 'héllo', 'hallo', 'ehllo', 'helloween',
+                      'yellow', 'hel', 'abcdefg', 'acbdeg']
+
+    def test_same_distances(self):
+        for query in ['', 'hello', 'abcdefg', 'x', 'hlelo']:
+            expected = [self.dev.distance(query, w) for w in self.words]
+            self.assertEqual(self.batch.distances(query, self.words), expected)
+            block = self.batch.prepare(self.words)
+            self.assertEqual(self.batch.distances(query, block), expected)
+
+    def test_limit(self):
+        for limit in [0, 3, 10, 25]:
+            expected = [self.dev.distance('hello', w, limit) for w in self.words]
+            self.assertEqual(self.batch.distances('hello', self.words, limit),
+                             expected)
+
+    def test_growing_alphabet(self):
+        words = list(self.words)
+        for c in 'xyzàäöüßqwrtu':
+            words.append('h%sllo' % c)
+            expected = [self.dev.distance('hëllo', w) for w in words]
+            self.assertEqual(self.batch.distances('hëllo', words), expected)
+        table = self.batch.get_compiled()
+        grown = self.batch.get_cost_matrix(table)
+        fresh = fwim.BatchEditDistanceEvaluator(self.penalties)
+        self.assertEqual(grown.tolist(), fresh.get_cost_matrix(table).tolist())
+        self.assertGreaterEqual(self.batch.cost_matrix[1].shape[0],
+                                len(table.characters))
+
+    def test_matcher(self):
+        matcher = fwim.BasicWordMatcher(self.penalties, self.batch)
+        plain = fwim.BasicWordMatcher(self.penalties)
+        for w in self.words:
+            matcher.add_word(w)
+            plain.add_word(w)
+        for query in ['hello', 'hlelo', 'acbd', '']:
+            self.assertEqual(sorted(matcher.find_within(query, 20)),
+                             sorted(plain.find_within(query, 20)))
+            self.assertEqual(matcher.find_closest(query)[0],
+                             plain.find_closest(query)[0])
+        matcher.add_word('hellp')
+        self.assertIn((10, 'hellp'), matcher.find_within('hello', 10))
+
+class TestBitParallel(unittest.TestCase):
+
+    def full_matrix_distance(self, dev, source, target):
+        # print_debug forces the dynamic programming path.
+        dev.print_debug = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = dev.distance(source, target)
+        dev.print_debug = False
+        return result
+
+    def test_detection(self):
+        self.assertEqual(fwim.EditDistanceEvaluator(
+            fwim.BasicPenalties()).get_compiled().uniform_cost, 10)
+        compiled = fwim.EditDistanceEvaluator(
+            fwim.PlainLevenshteinPenalties()).get_compiled()
+        self.assertEqual(compiled.uniform_cost, 10)
+        self.assertFalse(compiled.uniform_transpose)
+        for penalties in [fwim.DistinctPenalties(), fwim.LessEndPenalties(),
+                          fwim.CustomSwapPenalties()]:
+            compiled = fwim.EditDistanceEvaluator(penalties).get_compiled()
+            self.assertIsNone(compiled.uniform_cost)
+
+    def test_no_table(self):
+        # The bit-parallel path needs no codes, so the table stays empty.
+        dev = fwim.EditDistanceEvaluator(fwim.BasicPenalties())
+        self.assertEqual(dev.distance('abc', 'xbcd'), 20)
+        self.assertEqual(dev.get_compiled().characters, [])
+
+    def test_same_as_matrix(self):
+        pairs = [('abc', 'acb'), ('abcdefg', 'acbdeg'), ('ca', 'abc'),
+                 ('hello', 'ehllo'), ('aabb', 'abab'), ('abab', 'baba'),
+                 ('a'*70 + 'b', 'b' + 'a'*70), ('x', 'y'), ('abc', 'abc')]
+        for penalties in [fwim.BasicPenalties(), fwim.PlainLevenshteinPenalties()]:
+            dev = fwim.EditDistanceEvaluator(penalties)
+            for (source, target) in pairs:
+                self.assertEqual(dev.distance(source, target),
+                                 self.full_matrix_distance(dev, source, target))
+                self.assertEqual(dev.distance(target, source),
+                                 self.full_matrix_distance(dev, target, source))
+
 class TestEndAddEvaluator(unittest.TestCase):
     
     def setUp(self):
@@ -475,6 +635,118 @@ class TestCaseInsensitiveIgnoreOrderPenalties(unittest.TestCase):
         self.assertEqual(self.penalties.swap_cost('F', 'E'),
                     new_new_penalty)
 
+class TestCompiledPenalties(unittest.TestCase):
+
+    def setUp(self):
+        self.penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(self.penalties, 3)
+        self.penalties.set_penalty('o', 'p', 4)
+
+    def test_same_costs(self):
+        compiled = fwim.CompiledPenalties(self.penalties)
+        letters = 'aeopéëáx'
+        for c1 in letters:
+            for c2 in letters:
+                self.assertEqual(compiled.swap_cost(c1, c2),
+                                 self.penalties.swap_cost(c1, c2))
+        self.assertEqual(compiled.drop_penalty,
+                         self.penalties.get_drop_penalty())
+        self.assertEqual(compiled.end_add_penalty,
+                         self.penalties.get_end_add_penalty())
+
+    def test_sparse(self):
+        compiled = fwim.CompiledPenalties(self.penalties)
+        compiled.encode(''.join([chr(0x4e00 + i) for i in range(2000)]))
+        compiled.encode('aeopéëáx')
+        self.assertTrue(sum([len(row) for row in compiled.costs]) < 2100)
+        penalties = fwim.CaseInsensitiveIgnoreOrderPenalties()
+        penalties.set_penalty('c', 'd', 4)
+        compiled = fwim.CompiledPenalties(penalties)
+        letters = 'cCdDeE'
+        compiled.encode(letters)
+        for c1 in letters:
+            for c2 in letters:
+                self.assertEqual(compiled.swap_cost(c1, c2),
+                                 penalties.swap_cost(c1, c2))
+
+    def test_encode(self):
+        compiled = fwim.CompiledPenalties(self.penalties)
+        codes = compiled.encode('hello')
+        self.assertEqual(len(codes), 5)
+        self.assertEqual(codes[2], codes[3])
+        self.assertNotEqual(codes[0], codes[1])
+        self.assertEqual(codes, compiled.encode('hello'))
+
+    def test_frozen(self):
+        compiled = fwim.CompiledPenalties(self.penalties)
+        self.penalties.set_penalty('a', 'b', 1)
+        self.assertEqual(compiled.swap_cost('a', 'b'),
+                         self.penalties.get_swap_penalty())
+
+    def test_identity(self):
+        compiled = fwim.CompiledPenalties(self.penalties)
+        compiled.encode('abc')
+        self.assertTrue(compiled.free_identity)
+        penalties = fwim.CustomSwapPenalties()
+        penalties.set_penalty('b', 'b', 2)
+        compiled = fwim.CompiledPenalties(penalties)
+        compiled.encode('abc')
+        self.assertFalse(compiled.free_identity)
+        dev = fwim.EditDistanceEvaluator(penalties)
+        self.assertEqual(dev.distance('abc', 'abc'), 2)
+
+    def test_evaluator_recompiles(self):
+        dev = fwim.EditDistanceEvaluator(self.penalties)
+        swap_p = self.penalties.get_swap_penalty()
+        self.assertEqual(dev.distance('abc', 'xbc'), swap_p)
+        self.penalties.set_penalty('a', 'x', 1)
+        self.assertEqual(dev.distance('abc', 'xbc'), 1)
+        self.penalties.swap_penalty = 20
+        self.assertEqual(dev.distance('abc', 'ybc'), 20)
+
+class TestStringPool(unittest.TestCase):
+    def test_pool(self):
+        pool = fwim.StringPool(['hello', 'héllo', ''])
+        self.assertEqual(pool.add('hello'), 0)
+        self.assertEqual(pool.add('world'), 3)
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool[1], 'héllo')
+        self.assertEqual(pool[-1], 'world')
+        self.assertEqual(pool.index(''), 2)
+        self.assertEqual(pool.index('hallo'), -1)
+        self.assertTrue('héllo' in pool)
+        self.assertFalse('hallo' in pool)
+        self.assertFalse(None in pool)
+        self.assertEqual(list(pool), ['hello', 'héllo', '', 'world'])
+        with self.assertRaises(IndexError):
+            pool[4]
+        # append keeps duplicates, lookups find the first one.
+        self.assertEqual(pool.append('hello'), 4)
+        self.assertEqual(pool.index('hello'), 0)
+
+    def test_growth(self):
+        words = [str(i) for i in range(1000)]
+        pool = fwim.StringPool(words)
+        copied = pickle.loads(pickle.dumps(pool))
+        for (i, w) in enumerate(words):
+            self.assertEqual(pool.index(w), i)
+            self.assertEqual(copied.index(w), i)
+        self.assertTrue(len(pool.table) >= 2*len(words))
+
+    def test_view(self):
+        pool = fwim.StringPool(['c', 'a', 'b'])
+        view = fwim.StringPoolView(pool, array.array('i', [1, 2, 0]))
+        self.assertEqual(list(view), ['a', 'b', 'c'])
+        self.assertEqual(view[1:], ['b', 'c'])
+        self.assertEqual(view[0], 'a')
+        self.assertTrue('c' in view)
+        self.assertFalse('c' in fwim.StringPoolView(pool, array.array('i', [1])))
+        pool.add('dd')
+        short = fwim.StringPoolView(pool, array.array('i', [1, 2, 0]), 1)
+        self.assertTrue('c' in short)
+        self.assertFalse('dd' in short)
+        self.assertFalse('e' in short)
+
 class TestBasicWordMatcher(unittest.TestCase):
     def setUp(self):
         self.matcher = fwim.BasicWordMatcher()
@@ -521,10 +793,227 @@ class TestBasicWordMatcher(unittest.TestCase):
         self.assertEqual(len(self.matcher.find_within('aaa_aaa', 2*swap_p)), 3)
         self.assertEqual(len(self.matcher.find_within('aaa_aaa', 3*swap_p)), 4)
         
+    def test_closest_is_minimal(self):
+        words = ['germany', 'greece', 'georgia', 'ghana', 'guinea',
+                 'grenada', 'guyana', 'gabon', 'gambia', 'guatemala']
+        for w in words:
+            self.matcher.add_word(w)
+        dev = fwim.EditDistanceEvaluator(self.matcher.get_penalties())
+        for query in ['germ', 'gyana', 'guatemalla', 'xyz', 'ganbia', '']:
+            (penalty, match) = self.matcher.find_closest(query)
+            best = min(dev.distance(query, w) for w in words)
+            self.assertEqual(penalty, best)
+            self.assertEqual(dev.distance(query, match), best)
+
+    def test_scan_order(self):
+        for w in ['abcd', 'abc', 'xbc', 'ab', 'abcdefgh', 'bc']:
+            self.matcher.add_word(w)
+        order = list(self.matcher.scan_order('abc'))
+        self.assertEqual(sorted(order), sorted(self.matcher.words))
+        self.assertEqual(order[:2], ['abc', 'xbc'])
+        self.assertEqual(order[-1], 'abcdefgh')
+        order = list(self.matcher.scan_order('qqq'))
+        self.assertEqual(sorted(order), sorted(self.matcher.words))
+
+    def test_length_buckets(self):
+        for w in ['a', 'ab', 'abc', 'abcd', 'abcdefgh']:
+            self.matcher.add_word(w)
+        self.matcher.add_word('abc')
+        self.assertEqual(self.matcher.size(), 5)
+        add_p = self.matcher.get_penalties().get_add_penalty()
+        buckets = self.matcher.length_buckets('abc', add_p)
+        self.assertEqual([b[0] for b in buckets], [0, add_p, add_p])
+        self.assertEqual([b[1] for b in buckets], [3, 2, 4])
+        self.assertEqual(sorted(w for b in buckets for w in b[2]),
+                         ['ab', 'abc', 'abcd'])
+
+    def test_end_add_buckets(self):
+        penalties = fwim.LessEndPenalties()
+        matcher = fwim.BasicWordMatcher(penalties)
+        words = ['ger', 'germ', 'germany', 'georgia', 'g', 'algeria']
+        for w in words:
+            matcher.add_word(w)
+        dev = fwim.EditDistanceEvaluator(penalties)
+        for max_error in [0, 5, 8, 10, 20]:
+            expected = sorted(w for w in words
+                              if dev.distance('ger', w) <= max_error)
+            found = sorted(w for (d, w) in matcher.find_within('ger', max_error))
+            self.assertEqual(found, expected)
+        self.assertEqual(matcher.find_within('ger', 8)[-1], (8, 'germany'))
+
+    def test_folding(self):
+        self.assertEqual(fwim.fold_character('É'), 'e')
+        self.assertEqual(fwim.fold_character('ß'), 'ß')
+        self.assertEqual(fwim.fold_character('x', {'x' : 'y'}), 'y')
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        matcher = fwim.BasicWordMatcher(penalties)
+        for w in ['héllo', 'hello', 'hallo', 'hullo', 'Hëllö']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.fold('Hëllö'), 'hello')
+        self.assertEqual(sorted(matcher.folded_words('hello')),
+                         ['Hëllö', 'hello', 'héllo'])
+        self.assertEqual(matcher.fold_bound(), 10)
+        self.assertEqual(matcher.find_closest('hèllo'), (3, 'hello'))
+        self.assertEqual(sorted(matcher.find_within('hèllo', 6)),
+                         [(3, 'hello'), (3, 'héllo')])
+        # A cheap swap between different folded forms lowers the bound.
+        penalties.set_penalty('è', 'a', 2)
+        self.assertEqual(matcher.fold_bound(), 2)
+        self.assertEqual(sorted(matcher.find_within('hèllo', 6)),
+                         [(2, 'hallo'), (3, 'hello'), (3, 'héllo')])
+        self.assertEqual(matcher.find_closest('hèllo'), (2, 'hallo'))
+        # Words added after the index was used are folded on the next use.
+        matcher.add_word('HELLO')
+        self.assertEqual(sorted(matcher.folded_words('hello')),
+                         ['HELLO', 'Hëllö', 'hello', 'héllo'])
+        # Only the words that fold to something else are stored.
+        self.assertEqual(len(matcher.fold_ids), 3)
+
+    def test_no_fold_index(self):
+        matcher = fwim.BasicWordMatcher()
+        for w in ['héllo', 'hello', 'hallo']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.find_closest('héllo'), (0, 'héllo'))
+        self.assertEqual(matcher.find_within('héllo', 5), [(0, 'héllo')])
+        self.assertEqual(matcher.find_within('hèllo', 5), [])
+        self.assertFalse(matcher.fold_indexed)
+        self.assertEqual(len(matcher.folds), 0)
+
+    def test_complete(self):
+        matcher = fwim.CaseInsensitiveWordMatcher()
+        with open('list of countries.txt') as f:
+            for line in f:
+                if ' ' not in line.strip():
+                    matcher.add_word(line.strip())
+        self.assertEqual(matcher.complete('Ger'), [(0, 'germany')])
+        self.assertEqual(matcher.complete('gu', 0, 2),
+                         [(0, 'guam'), (0, 'guatemala')])
+        self.assertEqual(matcher.complete('xyz'), [])
+        matcher.add_word('germ')
+        self.assertIsNone(matcher.sorted_words)
+        self.assertEqual(matcher.complete('ger'), [(0, 'germ'), (0, 'germany')])
+        self.assertEqual(matcher.complete('ger', -5), [])
+        self.assertEqual(matcher.complete('gre', 10, 3),
+                         [(0, 'greece'), (0, 'greenland'), (0, 'grenada')])
+        self.assertEqual(matcher.complete('gremany', 10, 2), [(10, 'germany')])
+
+    def test_fuzzy_complete(self):
+        penalties = fwim.LessEndPenalties()
+        matcher = fwim.BasicWordMatcher(penalties)
+        words = ['germany', 'georgia', 'greece', 'ger', 'g', '', 'algeria']
+        for w in words:
+            matcher.add_word(w)
+        dev = fwim.EditDistanceEvaluator(penalties)
+        for prefix in ['', 'g', 'gre', 'egr', 'xgeo']:
+            for max_error in [0, 10, 20]:
+                expected = []
+                for w in words:
+                    d = min([dev.distance(prefix, w[:j]) for j in range(len(w) + 1)])
+                    if d <= max_error:
+                        expected.append((d, w))
+                self.assertEqual(matcher.complete(prefix, max_error),
+                                 sorted(expected))
+                self.assertEqual(matcher.complete(prefix, max_error, 2),
+                                 sorted(expected)[:2])
+        self.assertEqual(matcher.complete('ab', 10, limit=0), [])
+        self.assertEqual(fwim.BasicWordMatcher().complete('ab', 10), [])
+        top = fwim.TopK(0)
+        self.assertEqual(top.bound(), fwim.OVER_LIMIT)
+        top.offer(1, 'a')
+        self.assertEqual(top.result(), [])
+
+    def test_many(self):
+        matcher = fwim.BasicWordMatcher(fwim.LessEndPenalties())
+        for w in ['germany', 'georgia', 'greece', 'ger', 'g', '']:
+            matcher.add_word(w)
+        queries = ['ger', 'gremany', 'ger', 'xyz', '', 'greese', 'gremany']
+        within = list(matcher.find_within_many(queries, 20, 2))
+        self.assertEqual(sorted(q for (q, matches) in within),
+                         sorted(set(queries)))
+        for (q, matches) in within:
+            self.assertEqual(matches, matcher.find_within(q, 20))
+        closest = dict(matcher.find_closest_many(iter(queries)))
+        self.assertEqual(len(closest), len(set(queries)))
+        for q in queries:
+            self.assertEqual(closest[q][0], matcher.find_closest(q)[0])
+        with self.assertRaises(TypeError):
+            list(matcher.find_within_many(['ger', None], 10))
+
+    def test_many_normalized(self):
+        matcher = fwim.CaseInsensitiveWordMatcher()
+        matcher.add_word('Germany')
+        self.assertEqual(sorted(matcher.find_closest_many(['GERMANY', 'germany'])),
+                         [('GERMANY', (0, 'germany')), ('germany', (0, 'germany'))])
+
+    def test_many_shortcuts(self):
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        matcher = fwim.BasicWordMatcher(penalties)
+        for w in ['héllo', 'hello', 'hallo', 'germany', 'gérmany']:
+            matcher.add_word(w)
+        matcher.enable_cache()
+        matcher.enable_stats()
+        queries = ['hèllo', 'germäny']
+        # Below fold_bound() only the folded forms are checked.
+        self.assertEqual(dict(matcher.find_within_many(queries, 5)),
+                         dict((q, matcher.find_within(q, 5)) for q in queries))
+        self.assertEqual(matcher.stats()['evaluator.calls.distance'], 4)
+        self.assertEqual(dict(matcher.find_closest_many(queries)),
+                         {'hèllo' : (3, 'hello'), 'germäny' : (3, 'germany')})
+        calls = matcher.stats()['evaluator.calls.distance']
+        list(matcher.find_within_many(queries, 5))
+        list(matcher.find_closest_many(queries))
+        self.assertEqual(matcher.stats()['evaluator.calls.distance'], calls)
+
     def test_spaces(self):
         m_s = fwim.BasicWordMatcher(allow_spaces=True)
         m_s.add_word("foo bar")
 
+class TestTopK(unittest.TestCase):
+    def setUp(self):
+        self.words = ['aaa', 'aab', 'aba', 'baa', 'abb', 'bbb', 'aaaa', 'a', '']
+        self.dev = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+
+    def expected(self, query, k):
+        return sorted((self.dev.distance(query, w), w) for w in self.words)[:k]
+
+    def test_matcher(self):
+        matcher = fwim.BasicWordMatcher(fwim.PlainLevenshteinPenalties())
+        for w in self.words:
+            matcher.add_word(w)
+        for query in ['aaa', 'bab', 'b', '']:
+            for k in [0, 1, 2, 4, 20]:
+                self.assertEqual(matcher.find_top_k(query, k),
+                                 self.expected(query, k))
+
+    def test_ties(self):
+        matcher = fwim.BasicWordMatcher()
+        for w in ['abd', 'abc', 'abe', 'abf']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.find_top_k('abx', 2), [(10, 'abc'), (10, 'abd')])
+
+    def test_bktree(self):
+        bktree = fwim.BKTree(self.dev)
+        for w in self.words:
+            bktree.add_word(w)
+        for query in ['aaa', 'bab', 'b', '']:
+            for k in [0, 1, 2, 4, 20]:
+                self.assertEqual(bktree.find_top_k(query, k),
+                                 self.expected(query, k))
+
+    def test_case_insensitive(self):
+        matcher = fwim.CaseInsensitiveWordMatcher()
+        for w in ['One', 'Two', 'Three']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.find_top_k('ONE', 2), [(0, 'one'), (30, 'two')])
+        self.assertEqual(matcher.find_within('TWO', 0), [(0, 'two')])
+
+    def test_sort_by_distance(self):
+        pairs = [(20, 'a'), (0, 'b'), (10, 'c'), (0, 'd'), (20, 'e')]
+        self.assertEqual([p[0] for p in fwim.sort_by_distance(pairs)],
+                         [0, 0, 10, 20, 20])
+
 class TestCaseInsensitiveWordMatcher(unittest.TestCase):
     def setUp(self):
         self.matcher = fwim.CaseInsensitiveWordMatcher()
@@ -573,6 +1062,451 @@ class TestCaseInsensitiveWordMatcher(unittest.TestCase):
         self.assertEqual(match, 'four')
         self.assertEqual(penalty, 0)
 
+class TestTrieWordMatcher(unittest.TestCase, SameResults):
+    def test_penalties(self):
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        for p in [fwim.BasicPenalties(), fwim.LessEndPenalties(),
+                  fwim.DistinctPenalties(), penalties]:
+            self.check_same(fwim.TrieWordMatcher(p), p, top_k=3)
+
+    def test_bad_input(self):
+        trie = fwim.TrieWordMatcher()
+        with self.assertRaises(TypeError):
+            trie.add_word('a a')
+        with self.assertRaises(TypeError):
+            trie.add_word(None)
+        with self.assertRaises(TypeError):
+            trie.find_closest(None)
+        with self.assertRaises(TypeError):
+            trie.find_within(None, 10)
+
+    def test_empty(self):
+        trie = fwim.TrieWordMatcher()
+        self.assertEqual(trie.find_within('abc', 100), [])
+        trie.add_word('abc')
+        self.assertEqual(trie.find_closest('abd'), (10, 'abc'))
+
+class TestTwoStageWordMatcher(unittest.TestCase, SameResults):
+    def setUp(self):
+        self.words = COUNTRIES
+
+    def test_penalties(self):
+        groups = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(groups, 3)
+        swaps = fwim.CustomSwapPenalties()
+        swaps.set_penalty('a', 'e', 2)
+        for p in [fwim.BasicPenalties(), fwim.LessEndPenalties(), groups, swaps,
+                  fwim.CaseInsensitiveIgnoreOrderPenalties()]:
+            self.check_same(fwim.TwoStageWordMatcher(p), p, top_k=3)
+
+    def test_top_k_ties(self):
+        # 'e' is found first, but 'Acboep' is not a candidate for
+        # one edit and ties it, and it comes first by word.
+        matcher = fwim.TwoStageWordMatcher(fwim.LessEndPenalties())
+        for w in ['Acboep', 'e']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.find_top_k('A', 1), [(10, 'Acboep')])
+
+    def test_min_swap_cost(self):
+        self.assertEqual(fwim.BasicPenalties().min_swap_cost(), 10)
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        self.assertEqual(penalties.min_swap_cost(), 3)
+        compiled = fwim.CompiledPenalties(penalties)
+        self.assertEqual(compiled.min_edit_penalty, 3)
+
+    def test_stats(self):
+        matcher = fwim.TwoStageWordMatcher(fwim.LessEndPenalties())
+        for w in self.words:
+            matcher.add_word(w)
+        matcher.enable_stats()
+        matcher.find_within('germany', 10)
+        stats = matcher.stats()
+        self.assertEqual(stats['calls.find_within'], 1)
+        self.assertTrue(stats['verified'] < len(self.words))
+        self.assertTrue(stats['pruned'] > 0)
+        self.assertEqual(stats['results.find_within'], 2)
+        self.assertEqual(stats['bktree.calls.find'], 1)
+        for q in ['gremany', 'guinae', 'xyz']:
+            matcher.find_closest(q)
+        pruned = matcher.stats()['pruned']
+        self.assertTrue(0 <= pruned <= 1)
+
+    def test_folded_tree(self):
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        matcher = fwim.TwoStageWordMatcher(penalties)
+        for w in self.words:
+            matcher.add_word(w)
+        # 'gérmany' and 'grèece' share the folded forms of other words.
+        self.assertEqual(matcher.folded_tree().size(), len(self.words) - 2)
+        self.assertEqual(sorted(matcher.candidates('gremany', 1)),
+                         ['germany', 'gérmany'])
+
+class TestDeletionIndexMatcher(unittest.TestCase, SameResults):
+    def test_penalties(self):
+        for max_edits in [0, 1, 2]:
+            penalties = fwim.ErrorGroupPenalties()
+            fwim.add_accent_groups(penalties, 3)
+            for p in [fwim.BasicPenalties(), fwim.LessEndPenalties(), penalties]:
+                index = fwim.DeletionIndexMatcher(p, None, False, max_edits)
+                self.check_same(index, p)
+
+    def test_delete_variants(self):
+        self.assertEqual(fwim.delete_variants('abc', 0), set(['abc']))
+        self.assertEqual(fwim.delete_variants('abc', 1),
+                         set(['abc', 'bc', 'ac', 'ab']))
+        self.assertEqual(len(fwim.delete_variants('abc', 5)), 8)
+
+    def test_memory_report(self):
+        index = fwim.DeletionIndexMatcher(None, None, False, 1)
+        index.add_word('abc')
+        index.add_word('abd')
+        report = index.memory_report()
+        self.assertEqual(report['words'], 2)
+        self.assertEqual(report['deletions'], 7)
+        self.assertEqual(report['entries'], 8)
+        self.assertTrue(report['bytes'] > 0)
+        with self.assertRaises(TypeError):
+            fwim.DeletionIndexMatcher(None, None, False, -1)
+
+class TestQGramIndexMatcher(unittest.TestCase, SameResults):
+    def setUp(self):
+        self.words = ['united states', 'united kingdom', 'united arab emirates',
+                      'south africa', 'south korea', 'north korea', 'germany',
+                      'ger', 'g', '', 'gérmany']
+
+    def test_penalties(self):
+        queries = ['united sattes', 'suoth korea', 'north', 'ger', '', 'germäny']
+        for q in [1, 2, 3]:
+            penalties = fwim.ErrorGroupPenalties()
+            fwim.add_accent_groups(penalties, 3)
+            for p in [fwim.BasicPenalties(), fwim.LessEndPenalties(), penalties]:
+                index = fwim.QGramIndexMatcher(p, None, True, q)
+                self.check_same(index, p, self.words, queries)
+
+    def test_grams(self):
+        index = fwim.QGramIndexMatcher(None, None, False, 3)
+        self.assertEqual(index.grams('ab'), [('\0\0a', 0), ('\0ab', 1),
+                                             ('ab\0', 2), ('b\0\0', 3)])
+        index.add_word('ab')
+        self.assertEqual(list(index.postings['\0ab']), [0, 1])
+
+    def test_filter(self):
+        index = fwim.QGramIndexMatcher(None, None, True)
+        for w in self.words:
+            index.add_word(w)
+        self.assertEqual(index.candidates('south korea', 2),
+                         set(['south korea', 'north korea']))
+        with self.assertRaises(TypeError):
+            fwim.QGramIndexMatcher(None, None, False, 0)
+
+class TestShardedWordMatcher(unittest.TestCase, SameResults):
+    def setUp(self):
+        self.words = ['germany', 'georgia', 'greece', 'guinea', 'guinea-bissau',
+                      'gabon', 'gambia', 'ger', 'g', '', 'gérmany']
+        self.penalties = fwim.LessEndPenalties()
+        self.plain = fwim.BasicWordMatcher(self.penalties)
+        self.sharded = fwim.ShardedWordMatcher(self.penalties, False, 3)
+        for w in self.words:
+            self.plain.add_word(w)
+            self.sharded.add_word(w)
+
+    def tearDown(self):
+        self.sharded.close()
+
+    def test_same(self):
+        self.check_same(self.sharded, self.penalties, self.words, top_k=4)
+
+    def test_add_after_start(self):
+        self.assertEqual(self.sharded.size(), len(self.words))
+        self.sharded.add_word('gabun')
+        self.sharded.add_word('germany')
+        self.assertEqual(self.sharded.size(), len(self.words) + 1)
+        self.assertEqual(self.sharded.find_closest('gabun'), (0, 'gabun'))
+
+    def test_bad_input(self):
+        with self.assertRaises(TypeError):
+            self.sharded.add_word('a a')
+        with self.assertRaises(TypeError):
+            self.sharded.find_within(None, 10)
+        with self.assertRaises(TypeError):
+            fwim.ShardedWordMatcher(None, False, 0)
+
+    def test_worker_protocol(self):
+        (here, there) = multiprocessing.Pipe()
+        worker = threading.Thread(target=fwim.shard_worker,
+                                  args=(there, self.penalties, False, ['a'], None))
+        worker.start()
+        here.send(('add', 'b b'))
+        here.send(('add', 'c'))
+        here.send(('size',))
+        self.assertIsInstance(here.recv(), TypeError)
+        here.send(('size',))
+        self.assertEqual(here.recv(), 2)
+        here.send(('nonsense',))
+        self.assertIsInstance(here.recv(), ValueError)
+        here.send(('close',))
+        worker.join()
+        here.close()
+
+    def test_many(self):
+        queries = ['ger', 'gremany', 'ger', 'xyz', '']
+        within = dict(self.sharded.find_within_many(queries, 20, 2))
+        self.assertEqual(len(within), 4)
+        for q in queries:
+            self.assertEqual(sorted(within[q]),
+                             sorted(self.plain.find_within(q, 20)))
+        for (q, best) in self.sharded.find_closest_many(queries):
+            self.assertEqual(best[0], self.plain.find_closest(q)[0])
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = fwim.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (2, 1, 1))
+        self.assertEqual(stats['size'], 2)
+        with self.assertRaises(TypeError):
+            fwim.LRUCache(0)
+
+    def test_ttl(self):
+        now = [0]
+        cache = fwim.LRUCache(10, 5, lambda : now[0])
+        cache.put('a', 1)
+        now[0] = 5
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 6
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_matcher(self):
+        penalties = fwim.BasicPenalties()
+        matcher = fwim.CaseInsensitiveWordMatcher(penalties)
+        matcher.enable_cache(10)
+        for w in ['germany', 'greece', 'ghana']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.find_within('Gerany', 10), [(10, 'germany')])
+        self.assertEqual(matcher.find_within('gerany', 10), [(10, 'germany')])
+        self.assertEqual(matcher.cache.stats()['hits'], 1)
+        self.assertEqual(matcher.find_closest('gerany'), (10, 'germany'))
+        self.assertEqual(matcher.find_top_k('gerany', 2),
+                         [(10, 'germany'), (30, 'ghana')])
+        matcher.add_word('Gerany')
+        matcher.add_word('hungary')
+        self.assertEqual(matcher.find_within('gerany', 10),
+                         [(0, 'gerany'), (10, 'germany')])
+        self.assertEqual(matcher.find_closest('gerany'), (0, 'gerany'))
+        self.assertEqual(matcher.find_top_k('gerany', 2),
+                         [(0, 'gerany'), (10, 'germany')])
+        self.assertEqual(matcher.cache.stats()['hits'], 4)
+        # Other penalties give other keys.
+        penalties.add_penalty = 15
+        self.assertEqual(matcher.find_within('gerany', 10), [(0, 'gerany')])
+
+    def test_bktree(self):
+        bktree = fwim.BKTree(fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties()))
+        bktree.enable_cache()
+        for w in ['fool', 'foot', 'tool']:
+            bktree.add_word(w)
+        self.assertEqual(bktree.find('fooll', 10), [(10, 'fool')])
+        bktree.add_word('fooll')
+        bktree.add_word('fool')
+        self.assertEqual(bktree.find('fooll', 10), [(0, 'fooll'), (10, 'fool')])
+        self.assertEqual(bktree.find_top_k('tol', 1), [(10, 'tool')])
+        self.assertEqual(bktree.find_top_k('tol', 1), [(10, 'tool')])
+        self.assertEqual(bktree.cache.stats()['hits'], 2)
+
+class TestDistanceMemo(unittest.TestCase):
+    def test_memo(self):
+        penalties = fwim.BasicPenalties()
+        dev = fwim.EditDistanceEvaluator(penalties)
+        memo = dev.enable_memo(100)
+        self.assertEqual(dev.distance('hello', 'hallo'), 10)
+        self.assertEqual(dev.distance('hello', 'hallo'), 10)
+        self.assertEqual(dev.distance('hello', 'hallo', 5), fwim.OVER_LIMIT)
+        self.assertEqual(memo.stats()['hits'], 2)
+        # Only exact results are kept.
+        self.assertEqual(dev.distance('hello', 'world', 10), fwim.OVER_LIMIT)
+        self.assertEqual(len(memo), 1)
+        penalties.swap_penalty = 20
+        self.assertEqual(dev.distance('hello', 'hallo'), 20)
+
+    def test_shared(self):
+        dev = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+        memo = dev.enable_memo()
+        other = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+        other.enable_memo(memo=memo)
+        trees = [fwim.BKTree(dev), fwim.BKTree(other)]
+        for bktree in trees:
+            for w in ['fool', 'foot', 'tool', 'fooll', 'hello']:
+                bktree.add_word(w)
+        # The second tree is built from the first one's distances.
+        self.assertEqual(memo.stats()['hit_rate'], 0.5)
+        self.assertEqual(trees[0].find('fol', 10), trees[1].find('fol', 10))
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.words = ['germany', 'georgia', 'greece', 'guinea', 'gabon',
+                      'gambia', 'ghana', 'grenada']
+
+    def test_evaluator(self):
+        dev = fwim.EditDistanceEvaluator(fwim.LessEndPenalties())
+        self.assertEqual(dev.stats(), {})
+        dev.enable_stats()
+        self.assertEqual(dev.distance('hello', 'hallo'), 10)
+        self.assertEqual(dev.distance('hello', 'world', 5), fwim.OVER_LIMIT)
+        stats = dev.stats()
+        self.assertEqual(stats['calls.distance'], 2)
+        self.assertEqual(stats['over_limit.distance'], 1)
+        self.assertTrue(stats['cells'] > 0)
+        self.assertEqual(stats['early_exits'], 1)
+        dev.reset_stats()
+        self.assertEqual(dev.stats()['memory_bytes'], dev.memory_footprint())
+        self.assertFalse('calls.distance' in dev.stats())
+        dev.disable_stats()
+        self.assertFalse('distance' in dev.__dict__)
+        self.assertEqual(dev.stats(), {})
+
+    def test_bit_parallel(self):
+        dev = fwim.EditDistanceEvaluator(fwim.BasicPenalties())
+        dev.enable_stats()
+        dev.distance('hello', 'hallo')
+        self.assertEqual(dev.stats()['bit_parallel'], 1)
+        self.assertFalse('cells' in dev.stats())
+
+    def test_bktree(self):
+        bktree = fwim.BKTree(fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties()))
+        bktree.bulk_build(self.words, 1)
+        bktree.enable_stats()
+        bktree.find('germani', 10)
+        stats = bktree.stats()
+        self.assertTrue(stats['nodes_visited'] > 0)
+        self.assertTrue(stats['nodes_pruned'] > 0)
+        # Children of nodes over the limit are not seen at all.
+        self.assertTrue(stats['nodes_visited'] + stats['nodes_pruned'] <=
+                        len(self.words))
+        self.assertEqual(stats['evaluator.calls.distance'], stats['nodes_visited'])
+        self.assertTrue(stats['memory_bytes'] > 0)
+
+    def test_matcher(self):
+        matcher = fwim.DeletionIndexMatcher()
+        for w in self.words:
+            matcher.add_word(w)
+        exported = []
+        matcher.enable_stats(lambda name, stats : exported.append((name, stats)))
+        self.assertEqual(matcher.find_within('germani', 10), [(10, 'germany')])
+        stats = matcher.export_stats()
+        self.assertEqual(exported, [('DeletionIndexMatcher', stats)])
+        self.assertEqual(stats['calls.find_within'], 1)
+        self.assertEqual(stats['calls.candidates'], 1)
+        self.assertTrue(stats['candidates'] < len(self.words))
+        self.assertEqual(stats['evaluator.calls.distance'], stats['verified'])
+        matcher.disable_stats()
+        self.assertEqual(matcher.stats(), {})
+        self.assertEqual(matcher.dev.stats(), {})
+
+    def test_pickle(self):
+        matcher = fwim.BasicWordMatcher()
+        matcher.add_word('germany')
+        matcher.enable_stats()
+        copied = pickle.loads(pickle.dumps(matcher))
+        self.assertEqual(copied.stats(), {})
+        self.assertEqual(copied.find_closest('germani'), (10, 'germany'))
+
+class TestPhoneticWordMatcher(unittest.TestCase):
+    def test_soundex(self):
+        self.assertEqual(fwim.soundex('kirgistan'), 'K622')
+        self.assertEqual(fwim.soundex('Kyrgyzstan'), 'K622')
+        self.assertEqual(fwim.soundex('Robert'), 'R163')
+        self.assertEqual(fwim.soundex('Ashcraft'), 'A261')
+        self.assertEqual(fwim.soundex('Pfister'), 'P236')
+        self.assertEqual(fwim.soundex('Tymczak'), 'T522')
+        self.assertEqual(fwim.soundex('Élan'), 'E450')
+        self.assertEqual(fwim.soundex('123'), '')
+
+    def test_metaphone_key(self):
+        self.assertEqual(fwim.metaphone_key('kirgistan'), 'KRGSTN')
+        self.assertEqual(fwim.metaphone_key('Kyrgyzstan'), 'KRGSTN')
+        self.assertEqual(fwim.metaphone_key('Philippines'), 'FLPNS')
+        self.assertEqual(fwim.metaphone_key(''), '')
+
+    def test_sound_alike(self):
+        matcher = fwim.PhoneticWordMatcher(None, None, True)
+        with open('list of countries.txt') as f:
+            for line in f:
+                if line.strip():
+                    matcher.add_word(line.strip().lower())
+        self.assertEqual(matcher.phonetic_candidates('kirgistan'),
+                         set(['kyrgyzstan']))
+        self.assertEqual(matcher.find_sound_alike('kirgistan', 3),
+                         [(30, 'kyrgyzstan')])
+        # No sound-alikes, so this is a scan.
+        self.assertEqual(matcher.find_sound_alike('ger', 2),
+                         matcher.find_top_k('ger', 2))
+
+    def test_encoders(self):
+        matcher = fwim.PhoneticWordMatcher(None, None, False,
+                                           [fwim.soundex, fwim.metaphone_key], 2)
+        for w in ['france', 'francais', 'finland', '12']:
+            matcher.add_word(w)
+        self.assertEqual(matcher.phonetic_candidates('fransais'),
+                         set(['france', 'francais']))
+        self.assertEqual(matcher.find_sound_alike('fransais', 1),
+                         [(10, 'francais')])
+        self.assertEqual(matcher.phonetic_candidates('123'), set())
+
+class TestQuerySession(unittest.TestCase):
+    def setUp(self):
+        self.penalties = fwim.LessEndPenalties()
+        self.matcher = fwim.BasicWordMatcher(self.penalties, None, True)
+        for w in ['germany', 'georgia', 'greece', 'ghana', 'kyrgyzstan',
+                  'kazakhstan', 'south korea', 'ger', '']:
+            self.matcher.add_word(w)
+
+    def check(self, session):
+        expected = self.matcher.find_within(session.query, session.max_error)
+        self.assertEqual(sorted(session.results()), sorted(expected))
+
+    def test_typing(self):
+        session = self.matcher.session(30)
+        self.check(session)
+        for c in 'kirgistan':
+            session.append(c)
+            self.check(session)
+        self.assertEqual(session.query, 'kirgistan')
+        self.assertTrue(session.candidates() < self.matcher.size())
+        for k in range(4):
+            session.backspace()
+            self.check(session)
+        session.append('zstan')
+        self.check(session)
+        session.backspace(100)
+        self.assertEqual(session.query, '')
+        self.check(session)
+
+    def test_set_query(self):
+        session = self.matcher.session(20)
+        for query in ['ger', 'germ', 'gre', 'greece', 'south k', 'g', '']:
+            session.set_query(query)
+            self.assertEqual(session.query, query)
+            self.check(session)
+        self.assertEqual(session.candidates(), self.matcher.size())
+
+    def test_case_insensitive(self):
+        matcher = fwim.CaseInsensitiveWordMatcher()
+        matcher.add_word('Germany')
+        session = matcher.session(10)
+        session.append('GERMANY')
+        self.assertEqual(session.results(), [(0, 'germany')])
+
 class TestBKTree(unittest.TestCase):
     def setUp(self):
         self.penalties = fwim.PlainLevenshteinPenalties()
@@ -611,5 +1545,177 @@ class TestBKTree(unittest.TestCase):
         self.assertEqual(0, match[0][0])
         self.assertEqual('foot', match[0][1])
 
+    def test_bulk_build(self):
+        words = ['fool', 'foot', 'tool', 'food', 'good', 'mood', 'hood', 'wood',
+                 'wool', 'pool', 'poll', 'pole', 'hole', 'mole', 'role', 'rule',
+                 'mule', 'male', 'mile', 'pile', 'file', 'fill', 'fall', 'hall',
+                 'ball', 'bell', 'belt', 'bolt', 'boot', 'boat', 'coat', 'goat',
+                 'foot', 'fool']
+        for w in words:
+            self.bktree.add_word(w)
+        for workers in [1, 2, 6]:
+            bulk = fwim.BKTree(self.dev)
+            bulk.bulk_build(words, workers=workers, sample_size=4)
+            self.assertEqual(bulk.size(), self.bktree.size())
+            for query in ['fool', 'bolt', 'xyz', 'mall']:
+                for max_error in [0, 10, 20]:
+                    self.assertEqual(bulk.find(query, max_error),
+                                     self.bktree.find(query, max_error))
+        bulk.bulk_build(['fuel', 'fool'])
+        self.assertEqual(bulk.size(), self.bktree.size() + 1)
+        empty = fwim.BKTree(self.dev)
+        empty.bulk_build([])
+        self.assertEqual(empty.size(), 0)
+        self.assertEqual(empty.find('fool', 10), [])
+        split = fwim.BKTree(self.dev)
+        jobs = split.split_jobs(sorted(set(words)), 6, 2)
+        self.assertGreaterEqual(len(jobs), 6)
+        self.assertEqual(split.size() + sum(len(group) for (p, d, group) in jobs),
+                         len(set(words)))
+
+    def test_deep_tree(self):
+        # Single different characters are all at the same distance,
+        # so every word becomes a child of the previous one.
+        words = [chr(0x4e00 + k) for k in range(300)]
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(150)
+        try:
+            for w in words:
+                self.bktree.add_word(w)
+            self.assertEqual(len(self.bktree.find(words[0], 100)), 300)
+            self.assertEqual(self.bktree.find_top_k(words[-1], 1),
+                             [(0, words[-1])])
+        finally:
+            sys.setrecursionlimit(old_limit)
+        self.assertEqual(self.bktree.size(), 300)
+
+    def test_duplicates(self):
+        for w in ['fool', 'foot', 'fool', 'tool', 'foot']:
+            self.bktree.add_word(w)
+        self.assertEqual(self.bktree.size(), 3)
+        self.assertEqual(len(self.bktree.children(0)), 1)
+
+class TestIndexFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'test.idx')
+        self.words = ['fool', 'foot', 'tool', 'héllo', 'hello', 'a', '']
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_bktree(self):
+        dev = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+        bktree = fwim.BKTree(dev)
+        for w in self.words:
+            bktree.add_word(w)
+        bktree.save(self.filename)
+        dev = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+        mapped = fwim.load_bktree(self.filename, dev)
+        self.assertEqual(mapped.size(), bktree.size())
+        self.assertEqual(list(mapped.words), list(bktree.words))
+        for query in ['fool', 'hello', 'x', '']:
+            self.assertEqual(mapped.find(query, 20), bktree.find(query, 20))
+            self.assertEqual(mapped.find_top_k(query, 2),
+                             bktree.find_top_k(query, 2))
+        with self.assertRaises(TypeError):
+            mapped.add_word('wool')
+
+    def test_penalties_checked(self):
+        bktree = fwim.BKTree(fwim.EditDistanceEvaluator(
+            fwim.PlainLevenshteinPenalties()))
+        bktree.add_word('fool')
+        bktree.save(self.filename)
+        with self.assertRaises(ValueError):
+            fwim.load_bktree(self.filename,
+                             fwim.EditDistanceEvaluator(fwim.BasicPenalties()))
+        penalties = fwim.PlainLevenshteinPenalties()
+        penalties.swap_penalty = 5
+        with self.assertRaisesRegex(ValueError, 'swap_penalty is 10 in the file'):
+            fwim.load_bktree(self.filename, fwim.EditDistanceEvaluator(penalties))
+
+    def test_close(self):
+        bktree = fwim.BKTree(fwim.EditDistanceEvaluator(fwim.BasicPenalties()))
+        for w in self.words:
+            bktree.add_word(w)
+        bktree.save(self.filename)
+        dev = fwim.EditDistanceEvaluator(fwim.BasicPenalties())
+        with fwim.load_bktree(self.filename, dev) as mapped:
+            self.assertEqual(mapped.find('fool', 10), bktree.find('fool', 10))
+        self.assertTrue(mapped.index.mapping.closed)
+        with fwim.IndexFile(self.filename) as index:
+            self.assertEqual(list(index.words), list(bktree.words))
+        self.assertTrue(index.mapping.closed)
+
+    def test_words(self):
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        matcher = fwim.BasicWordMatcher(penalties)
+        for w in self.words:
+            matcher.add_word(w)
+        matcher.save(self.filename)
+        with self.assertRaises(ValueError):
+            fwim.load_words(self.filename, fwim.BasicWordMatcher())
+        with self.assertRaises(ValueError):
+            fwim.load_bktree(self.filename, fwim.EditDistanceEvaluator(penalties))
+        other = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(other, 3)
+        loaded = fwim.load_words(self.filename, fwim.BasicWordMatcher(other))
+        self.assertEqual(list(loaded.words), list(matcher.words))
+
+    def test_word_matcher(self):
+        penalties = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(penalties, 3)
+        matcher = fwim.BasicWordMatcher(penalties)
+        for w in self.words:
+            matcher.add_word(w)
+        matcher.save(self.filename)
+        with self.assertRaises(ValueError):
+            fwim.load_word_matcher(self.filename)
+        other = fwim.ErrorGroupPenalties()
+        fwim.add_accent_groups(other, 3)
+        with fwim.load_word_matcher(self.filename, other) as mapped:
+            self.assertEqual(list(mapped.words), list(matcher.words))
+            self.assertIn('héllo', mapped.words)
+            self.assertNotIn('hallo', mapped.words)
+            for query in ('fool', 'hello', 'tolo', 'x', ''):
+                self.assertEqual(mapped.find_within(query, 20),
+                                 matcher.find_within(query, 20))
+                self.assertEqual(mapped.find_closest(query),
+                                 matcher.find_closest(query))
+            self.assertEqual(mapped.complete('fo', 0), matcher.complete('fo', 0))
+            with self.assertRaises(TypeError):
+                mapped.add_word('new')
+
+    def test_truncated(self):
+        dev = fwim.EditDistanceEvaluator(fwim.PlainLevenshteinPenalties())
+        bktree = fwim.BKTree(dev)
+        for w in self.words:
+            bktree.add_word(w)
+        bktree.save(self.filename)
+        with open(self.filename, mode='rb') as ifile:
+            data = ifile.read()
+        for cut in [40, len(data) - 200]:
+            with open(self.filename, mode='wb') as ofile:
+                ofile.write(data[:-cut])
+            with self.assertRaises(ValueError):
+                fwim.load_bktree(self.filename, dev)
+        # An offset that goes back.
+        places = fwim.INDEX_HEADER.unpack_from(data, 0)[6:]
+        start = places[2*fwim.INDEX_SECTIONS.index('offsets')]
+        data = bytearray(data)
+        data[start+8:start+16] = (100).to_bytes(8, sys.byteorder)
+        with open(self.filename, mode='wb') as ofile:
+            ofile.write(data)
+        with self.assertRaises(ValueError):
+            fwim.load_bktree(self.filename, dev)
+
+    def test_bad_file(self):
+        ofile = open(self.filename, mode='wb')
+        ofile.write(b'not an index file at all' * 10)
+        ofile.close()
+        with self.assertRaises(ValueError):
+            fwim.load_words(self.filename, fwim.BasicWordMatcher())
+
 if __name__ == '__main__':
     unittest.main()